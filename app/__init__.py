@@ -1,30 +1,98 @@
+import atexit
+from datetime import timedelta
+
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_moment import Moment
 from flask_socketio import SocketIO
-from flask_sqlalchemy import SQLAlchemy
+
+from .archive import Compactor, MessageArchive
+from .cache import UserCache, create_cache
+from .database import SQLAlchemy, include_object
+from .instrumentation import Instrumentation
+from .notifications import Notifier
+from .presence import create_presence
+from .protocol import ChatSender
+from .receipts import ReadReceipts
+from .usernames import UsernameFilter
+from .workers import WorkerPool
+from .writebehind import BatchWriter, IdAllocator
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object('config')
 
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+instrumentation = Instrumentation(app, db)
+migrate = Migrate(app, db, include_object=include_object)
 bootstrap = Bootstrap(app)
 moment = Moment(app)
-socketio = SocketIO(app)
+socketio = SocketIO(app, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+notifier = Notifier(socketio, db.session)
+presence = create_presence(app.config['PRESENCE_URL'], ttl=app.config['PRESENCE_TTL'])
+chat_sender = ChatSender(socketio,
+                         encodings=app.config['CHAT_ENCODINGS'],
+                         interval=app.config['CHAT_FRAME_INTERVAL'],
+                         registry=lambda name: create_presence(app.config['PRESENCE_URL'],
+                                                               ttl=app.config['PRESENCE_TTL'],
+                                                               name=name))
+fragments = create_cache(app.config['FRAGMENT_CACHE_URL'],
+                         maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                         ttl=app.config['FRAGMENT_CACHE_TTL'],
+                         prefix='fragments:')
+workers = WorkerPool(app.config['WORKER_THREADS'])
+message_archive = MessageArchive(app.config['MESSAGE_ARCHIVE_FOLDER'])
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-from .models import User
+from .models import Conversation, Message, Sequence, User
+
+message_ids = IdAllocator(lambda count: Sequence.reserve('messages', count, Message.id),
+                          size=app.config['MESSAGE_ID_BLOCK_SIZE'])
+message_writer = BatchWriter(db,
+                             Message.save_batch,
+                             size=app.config['MESSAGE_BATCH_SIZE'],
+                             interval=app.config['MESSAGE_BATCH_INTERVAL'])
+atexit.register(message_writer.close)
+read_receipts = ReadReceipts(db,
+                             socketio,
+                             Conversation.save_read_marks,
+                             interval=app.config['READ_MARK_INTERVAL'],
+                             before_save=message_writer.flush)
+atexit.register(read_receipts.close)
+compactor = Compactor(
+    db,
+    message_archive,
+    Message.__table__,
+    Conversation.__table__,
+    archive_after=app.config['MESSAGE_ARCHIVE_AFTER_DAYS'] and timedelta(
+        days=app.config['MESSAGE_ARCHIVE_AFTER_DAYS']),
+    hot_limit=app.config['MESSAGE_HOT_LIMIT'],
+    retention=app.config['MESSAGE_RETENTION_DAYS'] and timedelta(
+        days=app.config['MESSAGE_RETENTION_DAYS']),
+    batch_size=app.config['MESSAGE_COMPACTION_BATCH'],
+    interval=app.config['MESSAGE_COMPACTION_INTERVAL'])
+user_cache = UserCache(create_cache(app.config['USER_CACHE_URL'],
+                                    maxsize=app.config['USER_CACHE_SIZE'],
+                                    ttl=app.config['USER_CACHE_TTL'],
+                                    prefix='users:',
+                                    shared=app.config['SOCKETIO_MESSAGE_QUEUE'] is not None),
+                       db.session,
+                       User)
+usernames = UsernameFilter(db,
+                           User,
+                           capacity=app.config['USERNAME_FILTER_CAPACITY'],
+                           error_rate=app.config['USERNAME_FILTER_ERROR_RATE'],
+                           ttl=app.config['USERNAME_FILTER_TTL'])
+app.before_first_request(usernames.start)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 
 @app.shell_context_processor
@@ -33,4 +101,4 @@ def make_context():
     return {'db': db, 'User': User}
 
 
-from . import views  # noqa: F401
+from . import commands, views  # noqa: F401
@@ -0,0 +1,417 @@
+'''
+Cold storage for chat messages: messages moved out of the `messages` table live in one
+SQLite file per month, grouped per conversation into zlib compressed chunks.
+
+Messages are archived oldest first per conversation, so for any conversation every
+archived message is older than every message left in the table, and a history page
+reads the table first and the archive only once the table has nothing older.
+'''
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from sqlalchemy import and_, exists, func, or_, select
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FILENAME = re.compile(r'^messages-(\d{4}-\d{2})\.db$')
+
+SEGMENT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    user1_id INTEGER NOT NULL,
+    user2_id INTEGER NOT NULL,
+    first_at TEXT NOT NULL,
+    last_at TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_chunks_user1_id_user2_id_last_at
+    ON chunks (user1_id, user2_id, last_at);
+CREATE TABLE IF NOT EXISTS ids (
+    id INTEGER PRIMARY KEY,
+    chunk_id INTEGER NOT NULL
+);
+'''
+
+
+def month(at):
+    return at.strftime('%Y-%m')
+
+
+def pair(row):
+    ''' Conversation of a message row, in the canonical order of `Conversation.key`. '''
+    return min(row[1], row[2]), max(row[1], row[2])
+
+
+def row_key(row):
+    return row[3], row[0]
+
+
+class MessageArchive:
+    '''
+    Monthly segments of archived messages in `folder`. Rows are tuples of
+    (id, sender_id, recipient_id, created_at, body).
+    '''
+
+    def __init__(self, folder, chunk_size=500, compression_level=6):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.connections = {}
+        self.lock = threading.RLock()
+
+    def path(self, name):
+        return os.path.join(self.folder, f'messages-{name}.db')
+
+    def months(self):
+        '''
+        Names of the existing segments, oldest first. Listed on every call, other workers
+        may have added or dropped some since.
+        '''
+        names = os.listdir(self.folder) if os.path.isdir(self.folder) else []
+        matches = filter(None, map(SEGMENT_FILENAME.match, names))
+        return sorted(match.group(1) for match in matches)
+
+    def segment(self, name, create=False):
+        with self.lock:
+            connection = self.connections.get(name)
+            if connection is None:
+                if not create and name not in self.months():
+                    return None
+                os.makedirs(self.folder, exist_ok=True)
+                connection = sqlite3.connect(self.path(name), timeout=30,
+                                             check_same_thread=False)
+                connection.executescript(SEGMENT_SCHEMA)
+                self.connections[name] = connection
+            return connection
+
+    def encode(self, rows):
+        data = [[id, sender_id, recipient_id, created_at.isoformat(), body]
+                for id, sender_id, recipient_id, created_at, body in rows]
+        return zlib.compress(json.dumps(data, separators=(',', ':')).encode(),
+                             self.compression_level)
+
+    @staticmethod
+    def decode(data):
+        return [(id, sender_id, recipient_id, datetime.fromisoformat(created_at), body)
+                for id, sender_id, recipient_id, created_at, body
+                in json.loads(zlib.decompress(data))]
+
+    def add(self, rows):
+        '''
+        Store message rows, skipping those already archived, so moving a batch again
+        after a crash doesn't duplicate it. Each segment is committed before returning.
+        '''
+        groups = {}
+        for row in sorted(rows, key=row_key):
+            groups.setdefault((month(row[3]), pair(row)), []).append(row)
+
+        with self.lock:
+            for (name, (user1_id, user2_id)), group in sorted(groups.items()):
+                connection = self.segment(name, create=True)
+                placeholders = ', '.join('?' * len(group))
+                archived = {id for id, in connection.execute(
+                    f'SELECT id FROM ids WHERE id IN ({placeholders})',
+                    [row[0] for row in group])}
+                group = [row for row in group if row[0] not in archived]
+
+                with connection:
+                    for start in range(0, len(group), self.chunk_size):
+                        chunk = group[start:start + self.chunk_size]
+                        chunk_id = connection.execute(
+                            'INSERT INTO chunks '
+                            '(user1_id, user2_id, first_at, last_at, count, data) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (user1_id, user2_id, chunk[0][3].isoformat(),
+                             chunk[-1][3].isoformat(), len(chunk), self.encode(chunk))).lastrowid
+                        connection.executemany('INSERT INTO ids (id, chunk_id) VALUES (?, ?)',
+                                               [(row[0], chunk_id) for row in chunk])
+
+    def history(self, user1_id, user2_id, before=None, until=None, limit=50):
+        '''
+        Up to `limit` archived messages between two users older than the `before`
+        (created_at, id) key, newest first. `until` is the time of the newest archived
+        message of the conversation, segments after it are not opened.
+        '''
+        user1_id, user2_id = min(user1_id, user2_id), max(user1_id, user2_id)
+        newest = [at for at in (before and before[0], until) if at is not None]
+        last_month = month(min(newest)) if newest else None
+
+        found = []
+        for name in reversed(self.months()):
+            if last_month is not None and name > last_month:
+                continue
+
+            connection = self.segment(name)
+            with self.lock:
+                chunks = connection.execute(
+                    'SELECT last_at, data FROM chunks '
+                    'WHERE user1_id = ? AND user2_id = ? AND first_at <= ? '
+                    'ORDER BY last_at DESC',
+                    (user1_id, user2_id, (before[0] if before else datetime.max).isoformat()),
+                ).fetchall()
+
+            for last_at, data in chunks:
+                # Chunks of a month may overlap, stop once no older chunk can make the page.
+                if len(found) >= limit and last_at < found[limit - 1][3].isoformat():
+                    break
+                found.extend(row for row in self.decode(data)
+                             if before is None or row_key(row) < tuple(before))
+                found.sort(key=row_key, reverse=True)
+
+            if len(found) >= limit:
+                break
+
+        return found[:limit]
+
+    def delete(self, message_id, sender_id=None):
+        ''' Remove an archived message, of `sender_id` only if given. Returns its row. '''
+        with self.lock:
+            for name in reversed(self.months()):
+                connection = self.segment(name)
+                located = connection.execute('SELECT chunk_id FROM ids WHERE id = ?',
+                                             (message_id,)).fetchone()
+                if located is None:
+                    continue
+
+                chunk_id, = located
+                data, = connection.execute('SELECT data FROM chunks WHERE id = ?',
+                                           (chunk_id,)).fetchone()
+                rows = self.decode(data)
+                row = next(row for row in rows if row[0] == message_id)
+                if sender_id is not None and row[1] != sender_id:
+                    return None
+
+                rows.remove(row)
+                with connection:
+                    connection.execute('DELETE FROM ids WHERE id = ?', (message_id,))
+                    if rows:
+                        connection.execute(
+                            'UPDATE chunks SET first_at = ?, last_at = ?, count = ?, data = ? '
+                            'WHERE id = ?',
+                            (rows[0][3].isoformat(), rows[-1][3].isoformat(), len(rows),
+                             self.encode(rows), chunk_id))
+                    else:
+                        connection.execute('DELETE FROM chunks WHERE id = ?', (chunk_id,))
+                return row
+        return None
+
+    def drop_before(self, at):
+        ''' Delete the segments of the months that ended before `at`. '''
+        with self.lock:
+            for name in self.months():
+                if name >= month(at):
+                    break
+                connection = self.connections.pop(name, None)
+                if connection is not None:
+                    connection.close()
+                os.remove(self.path(name))
+                logger.info('Deleted the archived messages of %s.', name)
+
+    @property
+    def stats(self):
+        months = self.months()
+        return {
+            'segments': len(months),
+            'bytes': sum(os.path.getsize(self.path(name)) for name in months),
+        }
+
+
+class Compactor:
+    '''
+    Keeps the `messages` table small: messages older than `archive_after`, and all but
+    the last `hot_limit` messages of a conversation, are moved to the archive. Messages
+    older than `retention` are deleted instead, with the archived months before it.
+
+    Works through `batch_size` conversations per run, and at most `max_messages` messages
+    per conversation per transaction, so chat writers are never locked out for long.
+
+    Only one process may compact at a time, see `flask compact-messages`.
+    '''
+
+    def __init__(self, db, archive, messages, conversations, archive_after=None,
+                 hot_limit=None, retention=None, batch_size=100, max_messages=500,
+                 interval=300):
+        self.db = db
+        self.archive = archive
+        self.messages = messages
+        self.conversations = conversations
+        self.archive_after = archive_after
+        self.hot_limit = hot_limit
+        self.retention = retention
+        self.batch_size = batch_size
+        self.max_messages = max_messages
+        self.interval = interval
+
+        self.position = (0, 0)
+        self.moved = 0
+        self.closed = False
+
+    @property
+    def enabled(self):
+        return bool(self.archive_after or self.hot_limit or self.retention)
+
+    def run(self):
+        ''' Compact every `interval` seconds until closed. '''
+        while not self.closed:
+            try:
+                while self.run_once() and not self.closed:
+                    # Give chat writers the database between batches.
+                    time.sleep(0.1)
+            except Exception:
+                logger.exception('Could not compact messages, will retry.')
+            time.sleep(self.interval)
+
+    def run_once(self, now=None):
+        '''
+        Compact the next `batch_size` conversations, return False once it went round all
+        of them. `moved` counts the messages archived or deleted so far.
+        '''
+        now = now or datetime.utcnow()
+        table = self.conversations
+        user1_id, user2_id = self.position
+
+        with self.db.engine.connect() as connection:
+            pairs = connection.execute(
+                select([table.c.user1_id, table.c.user2_id])
+                .where(or_(table.c.user1_id > user1_id,
+                           and_(table.c.user1_id == user1_id, table.c.user2_id > user2_id)))
+                .order_by(table.c.user1_id, table.c.user2_id)
+                .limit(self.batch_size)).fetchall()
+
+        if not pairs:
+            self.position = (0, 0)
+            if self.retention:
+                self.drop_archive(now - self.retention)
+            return False
+
+        self.position = tuple(pairs[-1])
+        for user1_id, user2_id in pairs:
+            self.moved += self.compact(user1_id, user2_id, now)
+        return True
+
+    def boundary(self, connection, user1_id, user2_id, now):
+        ''' (created_at, id) key of the oldest message of the conversation that stays hot. '''
+        keys = []
+        if self.archive_after:
+            keys.append((now - self.archive_after, 0))
+        if self.retention:
+            # Older messages are deleted by `compact` without being archived.
+            keys.append((now - self.retention, 0))
+        if self.hot_limit:
+            m = self.messages
+            newest = []
+            for sender_id, recipient_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                newest += connection.execute(
+                    select([m.c.created_at, m.c.id])
+                    .where(and_(m.c.sender_id == sender_id, m.c.recipient_id == recipient_id))
+                    .order_by(m.c.created_at.desc(), m.c.id.desc())
+                    .limit(self.hot_limit)).fetchall()
+            if len(newest) > self.hot_limit:
+                keys.append(tuple(sorted(newest, reverse=True)[self.hot_limit - 1]))
+        return max(keys, default=None)
+
+    def compact(self, user1_id, user2_id, now):
+        m = self.messages
+        with self.db.engine.connect() as connection:
+            boundary = self.boundary(connection, user1_id, user2_id, now)
+            if boundary is None:
+                return 0
+
+            created_at, message_id = boundary
+            rows = []
+            for sender_id, recipient_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                rows += connection.execute(
+                    select([m.c.id, m.c.sender_id, m.c.recipient_id, m.c.created_at, m.c.body])
+                    .where(and_(m.c.sender_id == sender_id, m.c.recipient_id == recipient_id,
+                                or_(m.c.created_at < created_at,
+                                    and_(m.c.created_at == created_at, m.c.id < message_id))))
+                    .order_by(m.c.created_at, m.c.id)
+                    .limit(self.max_messages)).fetchall()
+
+        if not rows:
+            return 0
+
+        rows = sorted(map(tuple, rows), key=row_key)[:self.max_messages]
+        expired = self.retention and now - self.retention
+        archived = [row for row in rows if not expired or row[3] >= expired]
+        if archived:
+            self.archive.add(archived)
+
+        # The archive is committed first: a crash in between leaves copies in both
+        # places, which the history merges and the next run doesn't archive twice.
+        with self.db.engine.begin() as connection:
+            connection.execute(m.delete().where(m.c.id.in_([row[0] for row in rows])))
+            if len(archived) < len(rows):
+                self.forget_expired(connection, user1_id, user2_id)
+            if archived:
+                c = self.conversations
+                connection.execute(
+                    c.update()
+                    .where(and_(c.c.user1_id == user1_id, c.c.user2_id == user2_id,
+                                or_(c.c.archived_at.is_(None),
+                                    c.c.archived_at < archived[-1][3])))
+                    .values(archived_at=archived[-1][3]))
+        return len(rows)
+
+    def forget_expired(self, connection, user1_id, user2_id):
+        '''
+        Fix the summary of a conversation after expired messages were deleted. Those were
+        the oldest ones left, older than any that stays, and every archived message is
+        older still. So an unread count can't be more than the messages the table still
+        has for its user, and without any the conversation has no last message.
+        '''
+        m, c = self.messages, self.conversations
+        where = and_(c.c.user1_id == user1_id, c.c.user2_id == user2_id)
+        conversation = connection.execute(
+            select([c.c.user1_unread, c.c.user2_unread]).where(where)).fetchone()
+        if conversation is None:
+            return
+
+        values = {}
+        for column, sender_id, recipient_id in (('user1_unread', user2_id, user1_id),
+                                                ('user2_unread', user1_id, user2_id)):
+            unread = conversation[column]
+            if unread:
+                left = connection.execute(select([func.count()]).select_from(
+                    select([m.c.id])
+                    .where(and_(m.c.sender_id == sender_id, m.c.recipient_id == recipient_id))
+                    .limit(unread).alias())).scalar()
+                if left < unread:
+                    values[column] = left
+
+        left = select([m.c.id]).where(
+            or_(and_(m.c.sender_id == user1_id, m.c.recipient_id == user2_id),
+                and_(m.c.sender_id == user2_id, m.c.recipient_id == user1_id)))
+        if not connection.execute(select([exists(left)])).scalar():
+            values.update(last_message_id=None, last_message_at=None, last_message_preview='')
+
+        if values:
+            connection.execute(c.update().where(where).values(**values))
+
+    def drop_archive(self, at):
+        '''
+        Delete the archived months that ended before `at`, and forget them in the
+        conversations: those whose last message was in them have no message left.
+        '''
+        self.archive.drop_before(at)
+        start = datetime(at.year, at.month, 1)
+
+        c = self.conversations
+        with self.db.engine.begin() as connection:
+            connection.execute(
+                c.update().where(c.c.last_message_at < start).values(
+                    last_message_id=None, last_message_at=None, last_message_preview='',
+                    user1_unread=0, user2_unread=0))
+            connection.execute(
+                c.update().where(c.c.archived_at < start).values(archived_at=None))
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,118 @@
+import hashlib
+import mimetypes
+import os
+import re
+import time
+import uuid
+from io import BytesIO
+
+from flask import current_app, request, send_from_directory
+from PIL import Image, ImageOps
+
+# Uploads are stored as `<key>-<size>.<ext>`, where the key is the hash of the upload.
+# `User.image` holds `<key>.<ext>`, older rows hold the name of the uploaded file.
+AVATAR_KEY = re.compile(r'^(?P<hash>[0-9a-f]{32})\.(?P<ext>jpg|png)$')
+AVATAR_FILENAME = re.compile(r'^(?P<hash>[0-9a-f]{32})-(?P<size>[a-z]+)\.(?P<ext>jpg|png)$')
+
+
+class InvalidAvatar(ValueError):
+    pass
+
+
+def is_avatar_key(image):
+    return image is not None and AVATAR_KEY.match(image) is not None
+
+
+def avatar_filename(image, size):
+    ''' Name of the stored variant of `image`, legacy images have a single one. '''
+    match = AVATAR_KEY.match(image)
+    if match is None:
+        return image
+    return f"{match['hash']}-{size}.{match['ext']}"
+
+
+def process_avatar(data, folder, sizes, quality=85):
+    '''
+    Decode an upload once and store a square, recompressed variant per item of `sizes`
+    (name -> pixels) in `folder`. Returns the key of the avatar. Identical uploads share
+    their files, so processing one again only hashes it.
+    '''
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    key = f'{digest}.jpg'
+    if all(os.path.exists(os.path.join(folder, avatar_filename(key, size))) for size in sizes):
+        return key
+
+    try:
+        image = Image.open(BytesIO(data))
+        # Let the JPEG decoder scale down while decoding when the upload is much larger.
+        image.draft('RGB', (max(sizes.values()),) * 2)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise InvalidAvatar('Could not read the image.') from e
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # Largest first, every variant is scaled down from the previous one.
+    for size, pixels in sorted(sizes.items(), key=lambda item: -item[1]):
+        image = ImageOps.fit(image, (pixels, pixels), Image.LANCZOS)
+        save_file(folder, avatar_filename(key, size),
+                  lambda f: image.save(f, 'JPEG', quality=quality, optimize=True,
+                                       progressive=True))
+    return key
+
+
+def save_file(folder, filename, write):
+    ''' Write a file under a temporary name and move it into place, readers never see half. '''
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        return
+    os.makedirs(folder, exist_ok=True)
+    temporary = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            write(f)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def send_avatar_file(folder, filename, max_age):
+    '''
+    Response for a stored variant. Its name is derived from its content, so it is the
+    ETag, a matching If-None-Match gets a 304 without touching the disk, and the file
+    may be cached as immutable for `max_age`.
+
+    With AVATAR_ACCEL_REDIRECT set the front-end server (nginx) sends the file from the
+    internal location it names, with USE_X_SENDFILE Flask asks Apache or lighttpd to.
+    Otherwise the file is streamed through the WSGI server's file wrapper.
+    '''
+    if filename in request.if_none_match:
+        response = current_app.response_class(status=304)
+    elif current_app.config['AVATAR_ACCEL_REDIRECT']:
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        location = current_app.config['AVATAR_ACCEL_REDIRECT'] + filename
+        response.headers['X-Accel-Redirect'] = location
+    else:
+        response = send_from_directory(folder, filename, add_etags=False)
+
+    response.set_etag(filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    response.expires = int(time.time() + max_age)
+    return response
+
+
+def send_legacy_avatar_file(folder, filename):
+    ''' Response for an image stored under its upload name, which may be replaced. '''
+    response = send_from_directory(folder, filename, conditional=True, cache_timeout=0)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,275 @@
+import pickle
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+class Cache(ABC):
+    '''
+    Key/value cache whose entries expire `ttl` seconds after they were set.
+
+    `generation()` changes with every `delete` and `clear`. A value loaded after reading
+    it is only stored by `set(key, value, generation)` if nothing was deleted meanwhile,
+    so a load that raced an invalidation can't put the old value back.
+    '''
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.hits = self.misses = 0
+
+    @abstractmethod
+    def get(self, key, default=None):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, generation=None):
+        pass
+
+    @abstractmethod
+    def generation(self):
+        pass
+
+    @abstractmethod
+    def delete(self, *keys):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def get_or_set(self, key, function):
+        value = self.get(key)
+        if value is None:
+            value = function()
+            self.set(key, value)
+        return value
+
+    @property
+    def stats(self):
+        ''' Hits and misses of this process, even when the entries are shared. '''
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class TTLCache(Cache):
+    '''
+    Bounded in-process cache: the least recently used entries are evicted beyond
+    `maxsize`. Safe to share between threads and greenlets.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.deletes = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[1] <= time.monotonic():
+                self.data.pop(key, None)
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.deletes:
+                return
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            self.deletes += 1
+            for key in keys:
+                self.data.pop(key, None)
+
+    def generation(self):
+        return self.deletes
+
+    def clear(self):
+        with self.lock:
+            self.deletes += 1
+            self.data.clear()
+
+    @property
+    def stats(self):
+        return {**super().stats, 'size': len(self.data)}
+
+
+class RedisCache(Cache):
+    '''
+    Cache shared by all workers, values are pickled under `prefix` + key. The generation
+    is kept outside of the prefix, so `clear` can't reset it.
+    '''
+
+    def __init__(self, url, ttl=60, prefix='cache:'):
+        import redis
+
+        super().__init__(ttl)
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.generation_key = f'generation:{prefix}'
+
+    def key(self, key):
+        return f'{self.prefix}{key}'
+
+    def get(self, key, default=None):
+        value = self.redis.get(self.key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, generation=None):
+        if generation is None:
+            self.redis.set(self.key(key), pickle.dumps(value), ex=self.ttl)
+            return
+
+        import redis
+
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self.generation_key)
+                if int(pipe.get(self.generation_key) or 0) != generation:
+                    return
+                pipe.multi()
+                pipe.set(self.key(key), pickle.dumps(value), ex=self.ttl)
+                pipe.execute()
+            except redis.WatchError:
+                pass
+
+    def delete(self, *keys):
+        if keys:
+            with self.redis.pipeline() as pipe:
+                pipe.incr(self.generation_key)
+                pipe.delete(*map(self.key, keys))
+                pipe.execute()
+
+    def generation(self):
+        return int(self.redis.get(self.generation_key) or 0)
+
+    def clear(self):
+        self.redis.incr(self.generation_key)
+        for key in self.redis.scan_iter(f'{self.prefix}*'):
+            self.redis.delete(key)
+
+
+def create_cache(url, maxsize=1024, ttl=60, prefix='cache:', shared=False):
+    '''
+    Pick a backend from an URL: memory:// or redis://host. A `shared` cache must be the
+    same for every worker, it can't be memory://.
+    '''
+    scheme = urlparse(url).scheme
+
+    if scheme == 'memory':
+        if shared:
+            raise ValueError(f'{url} is not shared between workers, use redis://')
+        return TTLCache(maxsize, ttl)
+    if scheme in ('redis', 'rediss'):
+        return RedisCache(url, ttl, prefix)
+
+    raise ValueError(f'Unsupported cache backend: {url}')
+
+
+class UserCache:
+    '''
+    Users by id and username, kept as their column values so any backend can hold them.
+    Cached users are attached to the session without a query. Users changed through the
+    session are dropped from the cache once the change is committed.
+
+    `exclude` columns are not cached, they are loaded from the database on first access.
+    '''
+
+    def __init__(self, cache, session, model, exclude=('password',)):
+        self.cache = cache
+        self.session = session
+        self.model = model
+        self.columns = [c.key for c in model.__mapper__.column_attrs if c.key not in exclude]
+
+        event.listen(session, 'after_flush', self.collect_changes)
+        event.listen(session, 'after_commit', self.drop_changes)
+        event.listen(session, 'after_rollback', self.forget_changes)
+
+    @staticmethod
+    def id_key(user_id):
+        return f'user:{user_id}'
+
+    @staticmethod
+    def username_key(username):
+        return f'username:{username}'
+
+    def get(self, user_id):
+        # Keep the instance this session already has, and its pending changes.
+        user = self.session.identity_map.get(identity_key(self.model, user_id))
+        if user is not None:
+            return user
+
+        values = self.cache.get(self.id_key(user_id))
+        if values is None:
+            generation = self.cache.generation()
+            user = self.model.query.get(user_id)
+            if user is not None:
+                self.add(user, generation)
+            return user
+        return self.attach(values)
+
+    def get_by_username(self, username):
+        user_id = self.cache.get(self.username_key(username))
+        if user_id is None:
+            generation = self.cache.generation()
+            user = self.model.query.filter_by(username=username).first()
+            if user is not None:
+                self.add(user, generation)
+            return user
+        return self.get(user_id)
+
+    def add(self, user, generation=None):
+        ''' Cache a user loaded after `generation` was read, see `Cache`. '''
+        self.cache.set(self.id_key(user.id),
+                       {key: getattr(user, key) for key in self.columns},
+                       generation)
+        self.cache.set(self.username_key(user.username), user.id, generation)
+
+    def attach(self, values):
+        user = self.model.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return self.session.merge(user, load=False)
+
+    def invalidate(self, *user_ids):
+        ''' Drop users changed without the ORM, once the session commits. '''
+        self.session.info.setdefault('changed_users', set()).update(map(self.id_key, user_ids))
+
+    def collect_changes(self, session, flush_context):
+        changed = session.info.setdefault('changed_users', set())
+        for instance in session.new | session.dirty | session.deleted:
+            if isinstance(instance, self.model):
+                changed.add(self.id_key(instance.id))
+                # The old username too, if it was changed.
+                usernames = inspect(instance).attrs.username.history.sum()
+                changed.update(map(self.username_key, usernames))
+
+    def drop_changes(self, session):
+        self.cache.delete(*session.info.pop('changed_users', ()))
+
+    def forget_changes(self, session):
+        session.info.pop('changed_users', None)
+
+    @property
+    def stats(self):
+        return self.cache.stats
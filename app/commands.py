@@ -0,0 +1,51 @@
+import click
+
+from . import app, compactor, db
+from .search import rebuild_search
+from .seed import build
+
+
+@app.cli.command()
+@click.option('--users', default=1000, show_default=True)
+@click.option('--friends', default=20.0, show_default=True, help='Mean friends per user.')
+@click.option('--requests', default=2.0, show_default=True,
+              help='Mean pending requests sent per user.')
+@click.option('--conversations', default=0.2, show_default=True,
+              help='Share of friendships with messages.')
+@click.option('--messages', default=20.0, show_default=True,
+              help='Mean messages per conversation.')
+@click.option('--seed', default=0, show_default=True, help='Same seed, same dataset.')
+@click.option('--processes', type=int, help='Generating processes, all CPUs by default.')
+@click.option('--password', default='password', show_default=True)
+def seed(users, friends, requests, conversations, messages, seed, processes, password):
+    ''' Add a reproducible load-test dataset to the database. '''
+    build(db, users, friends=friends, requests=requests, conversations=conversations,
+          messages=messages, seed=seed, processes=processes, password=password, log=click.echo)
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    ''' Create missing full text indexes and rebuild them from the users and messages. '''
+    with db.engine.begin() as connection:
+        rebuild_search(connection)
+    click.echo('Search indexes rebuilt.')
+
+
+@app.cli.command('compact-messages')
+@click.option('--watch', is_flag=True,
+              help='Keep compacting every MESSAGE_COMPACTION_INTERVAL seconds.')
+def compact_messages(watch):
+    '''
+    Move cold messages to the archive, see MESSAGE_ARCHIVE_AFTER_DAYS. Run it in one
+    process only, from cron or as a service with --watch.
+    '''
+    if not compactor.enabled:
+        raise click.UsageError('No retention policy is configured.')
+    if watch:
+        if not compactor.interval:
+            raise click.UsageError('MESSAGE_COMPACTION_INTERVAL is 0.')
+        compactor.run()
+        return
+    while compactor.run_once():
+        pass
+    click.echo(f'{compactor.moved} messages archived or deleted.')
@@ -0,0 +1,53 @@
+import re
+
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    ''' Run `PRAGMA name=value` for every item of `pragmas` on each new connection. '''
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+# Full text indexes and their shadow tables are created with raw DDL, see `app.search`.
+UNMANAGED_TABLES = re.compile(r'^\w+_search(_(config|content|data|docsize|idx))?$')
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    ''' Keep `flask db migrate` from dropping tables that have no model. '''
+    return not (type_ == 'table' and reflected and compare_to is None
+                and UNMANAGED_TABLES.match(name))
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    '''
+    Applies the SQLite profile from the config: SQLITE_PRAGMAS on every connection
+    and a sized connection pool instead of opening a connection per checkout.
+    Other databases get SQLALCHEMY_ENGINE_OPTIONS as is.
+    '''
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.drivername.startswith('sqlite'):
+            if engine_opts.get('poolclass') is StaticPool:
+                # In-memory databases live in a single connection, there is nothing to size.
+                for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                    engine_opts.pop(option, None)
+            elif engine_opts.get('pool_size'):
+                # SQLAlchemy's SQLite dialect picks a NullPool for file databases when no
+                # pool class is given, and the pool options would be ignored.
+                engine_opts['poolclass'] = QueuePool
+                engine_opts.setdefault('connect_args', {})['check_same_thread'] = False
+
+        engine = super().create_engine(sa_url, engine_opts)
+
+        if engine.dialect.name == 'sqlite':
+            set_sqlite_pragmas(engine, self.get_app().config.get('SQLITE_PRAGMAS', {}))
+
+        return engine
@@ -3,7 +3,7 @@ from flask_wtf.file import FileAllowed, FileField, FileRequired
 from wtforms import PasswordField, StringField, SubmitField
 from wtforms.validators import DataRequired, EqualTo, Length, ValidationError
 
-from .models import User
+from . import usernames
 
 
 class LoginForm(FlaskForm):
@@ -27,7 +27,7 @@ class RegisterForm(FlaskForm):
     submit = SubmitField('Create account')
 
     def validate_username(self, field):
-        if User.query.filter_by(username=field.data).first() is not None:
+        if usernames.taken([field.data]):
             raise ValidationError('User with this username already exists.')
 
 
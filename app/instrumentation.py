@@ -0,0 +1,180 @@
+import heapq
+import random
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+class RequestMetrics:
+    ''' What one request or socket event did, collected in `g.metrics`. '''
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.commits = 0
+        self.db_time = 0.0
+        self.slowest = []
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+class EndpointStats:
+    ''' Totals of the sampled requests of one endpoint. '''
+
+    def __init__(self, keep_slowest, keep_latencies=1024):
+        self.keep_slowest = keep_slowest
+        self.count = 0
+        self.time = 0.0
+        self.db_time = 0.0
+        self.statements = 0
+        self.max_statements = 0
+        self.latencies = deque(maxlen=keep_latencies)
+        self.slowest = []
+
+    def add(self, metrics, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.db_time += metrics.db_time
+        self.statements += metrics.statements
+        self.max_statements = max(self.max_statements, metrics.statements)
+        self.latencies.append(elapsed)
+        for item in metrics.slowest:
+            push_bounded(self.slowest, item, self.keep_slowest)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+        return {
+            'count': self.count,
+            'mean_ms': self.time / self.count * 1000,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            'db_mean_ms': self.db_time / self.count * 1000,
+            'statements_mean': self.statements / self.count,
+            'statements_max': self.max_statements,
+            'slowest_statements': [{'ms': duration * 1000, 'statement': statement}
+                                   for duration, statement in sorted(self.slowest, reverse=True)],
+        }
+
+
+def push_bounded(heap, item, size):
+    ''' Keep the `size` largest items in a min-heap. '''
+    if len(heap) < size:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+class Instrumentation:
+    '''
+    Statement count, database time, slowest statements and wall time of HTTP requests
+    and Socket.IO events, aggregated per endpoint.
+
+    Opt-in: with INSTRUMENTATION off and no DB_STATS_HEADERS nothing is hooked. Only a
+    INSTRUMENTATION_SAMPLE_RATE share of the requests is measured, so it can stay on in
+    production. DB_STATS_HEADERS measures every request and reports it in X-DB-* and
+    X-Request-Time headers.
+    '''
+
+    def __init__(self, app, db):
+        self.enabled = app.config['INSTRUMENTATION']
+        self.headers = app.config['DB_STATS_HEADERS']
+        self.sample_rate = app.config['INSTRUMENTATION_SAMPLE_RATE']
+        self.keep_slowest = app.config['INSTRUMENTATION_SLOWEST']
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+        if not (self.enabled or self.headers):
+            return
+
+        with app.app_context():
+            engine = db.engine
+
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        event.listen(db.session, 'after_commit', self.after_commit)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def start(self, endpoint):
+        ''' Measure the current request, or a sample of them. '''
+        if self.headers or random.random() < self.sample_rate:
+            g.metrics = RequestMetrics(endpoint)
+
+    def finish(self):
+        metrics = g.pop('metrics', None)
+        if metrics is None:
+            return None
+
+        elapsed = metrics.elapsed
+        if self.enabled:
+            with self.lock:
+                stats = self.endpoints.get(metrics.endpoint)
+                if stats is None:
+                    stats = self.endpoints[metrics.endpoint] = EndpointStats(self.keep_slowest)
+                stats.add(metrics, elapsed)
+        return metrics, elapsed
+
+    @staticmethod
+    def current():
+        return g.get('metrics') if has_request_context() else None
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current() is not None:
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        metrics = self.current()
+        if metrics is None or not conn.info.get('query_start'):
+            return
+        duration = time.perf_counter() - conn.info['query_start'].pop()
+        metrics.statements += 1
+        metrics.db_time += duration
+        push_bounded(metrics.slowest, (duration, statement), self.keep_slowest)
+
+    def after_commit(self, session):
+        metrics = self.current()
+        if metrics is not None:
+            metrics.commits += 1
+
+    def before_request(self):
+        self.start(request.endpoint or '<unmatched>')
+
+    def after_request(self, response):
+        result = self.finish()
+        if result is not None and self.headers:
+            metrics, elapsed = result
+            response.headers['X-DB-Statements'] = metrics.statements
+            response.headers['X-DB-Commits'] = metrics.commits
+            response.headers['X-DB-Time'] = f'{metrics.db_time * 1000:.2f}ms'
+            response.headers['X-Request-Time'] = f'{elapsed * 1000:.2f}ms'
+        return response
+
+    def socket_handler(self, f):
+        ''' Measure a Socket.IO event handler, put it under @socketio.on. '''
+        if not self.enabled:
+            return f
+
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            self.start(f'socket:{request.namespace}:{request.event["message"]}')
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.finish()
+
+        return wrapped
+
+    def snapshot(self):
+        with self.lock:
+            return {endpoint: stats.snapshot() for endpoint, stats in self.endpoints.items()}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
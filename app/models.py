@@ -2,16 +2,62 @@ from datetime import datetime
 
 from flask import url_for
 from flask_login import UserMixin
+from sqlalchemy import and_, exists, func, literal, or_, select, union_all
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.associationproxy import association_proxy
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy.orm import aliased
 
-from . import db
+from . import db, message_archive
+from .passwords import hash_password, needs_rehash, verify_password
+from .serializers import avatar_url
+
+
+class Sequence(db.Model):
+    ''' Named counters handing out ids before rows are written, see `IdAllocator`. '''
+
+    __tablename__ = 'sequences'
+
+    name = db.Column(db.String(64), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def reserve(cls, name, count, column):
+        '''
+        Reserve `count` consecutive values, never below the largest value of `column`,
+        and return the first one. Runs in a transaction of its own.
+        '''
+        table = cls.__table__
+        for attempt in range(2):
+            try:
+                with db.engine.begin() as connection:
+                    # Write first, so the row stays locked until the transaction ends.
+                    connection.execute(table.update().where(table.c.name == name).values(
+                        next_value=table.c.next_value + count))
+                    end = connection.execute(
+                        select([table.c.next_value]).where(table.c.name == name)).scalar()
+                    floor = connection.execute(
+                        select([func.coalesce(func.max(column), 0) + 1])).scalar()
+
+                    if end is None:
+                        connection.execute(table.insert().values(name=name,
+                                                                 next_value=floor + count))
+                        return floor
+                    if end - count < floor:
+                        connection.execute(table.update().where(table.c.name == name).values(
+                            next_value=floor + count))
+                        return floor
+                    return end - count
+            except IntegrityError:
+                # Another worker created the counter first.
+                if attempt:
+                    raise
 
 
 class Message(db.Model):
 
     __tablename__ = 'messages'
+    __table_args__ = (db.Index('ix_messages_sender_id_recipient_id_created_at', 'sender_id',
+                               'recipient_id', 'created_at'),)
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -33,10 +79,305 @@ class Message(db.Model):
     def formatted_created_at(self):
         return self.created_at.strftime('%m/%d/%Y %H:%M:%S')
 
+    @classmethod
+    def save_batch(cls, session, messages):
+        ''' Insert already numbered messages with one executemany, see `BatchWriter`. '''
+        session.execute(cls.__table__.insert(), [{
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'recipient_id': message.recipient_id,
+            'body': message.body,
+            'created_at': message.created_at,
+        } for message in messages])
+        Conversation.record_messages(messages, session)
+
+    @classmethod
+    def from_archive(cls, row):
+        ''' Transient message of an archived row, see `MessageArchive`. '''
+        id, sender_id, recipient_id, created_at, body = row
+        return cls(id=id, sender_id=sender_id, recipient_id=recipient_id, body=body,
+                   created_at=created_at)
+
+    @property
+    def cursor(self):
+        ''' Opaque keyset position of the message, see `history`. '''
+        return f'{self.created_at.isoformat()}_{self.id}'
+
+    @staticmethod
+    def parse_cursor(cursor):
+        created_at, _, message_id = cursor.rpartition('_')
+        return datetime.fromisoformat(created_at), int(message_id)
+
+    @classmethod
+    def history(cls, user1_id, user2_id, before=None, limit=50):
+        '''
+        Return a page of at most `limit` messages between two users, oldest first,
+        and the cursor of the next (older) page or None.
+
+        Each direction is an index range scan on (sender_id, recipient_id, created_at),
+        so the cost of a page does not depend on the length of the conversation. Older
+        messages are read from the archive once the table has none left.
+        '''
+        if before is not None:
+            before = cls.parse_cursor(before)
+
+        pages = []
+        for sender_id, recipient_id in ((user1_id, user2_id), (user2_id, user1_id)):
+            query = cls.query.filter(cls.sender_id == sender_id, cls.recipient_id == recipient_id)
+            if before is not None:
+                created_at, message_id = before
+                query = query.filter(
+                    or_(cls.created_at < created_at,
+                        and_(cls.created_at == created_at, cls.id < message_id)))
+            pages.append(
+                query.order_by(cls.created_at.desc(), cls.id.desc()).limit(limit + 1).all())
+
+        messages = sorted(pages[0] + pages[1], key=lambda m: (m.created_at, m.id))
+
+        if len(messages) <= limit:
+            conversation = Conversation.get(user1_id, user2_id)
+            if conversation is not None and conversation.archived_at is not None:
+                oldest = (messages[0].created_at, messages[0].id) if messages else before
+                rows = message_archive.history(user1_id, user2_id, before=oldest,
+                                               until=conversation.archived_at,
+                                               limit=limit + 1 - len(messages))
+                # A crash while archiving can leave a message in both places.
+                hot = {message.id for message in messages}
+                messages[:0] = [cls.from_archive(row) for row in reversed(rows)
+                                if row[0] not in hot]
+
+        if len(messages) > limit:
+            messages = messages[-limit:]
+            return messages, messages[0].cursor
+        return messages, None
+
+
+class Conversation(db.Model):
+    '''
+    Denormalized summary of the messages between two users, used by the inbox.
+
+    The pair is stored in canonical order (user1_id < user2_id), so a conversation
+    is found with a single primary key lookup whoever sent the message.
+    '''
+
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.CheckConstraint('user1_id < user2_id', name='ck_conversations_user_order'),
+        db.Index('ix_conversations_user1_id_last_message_at_user2_id',
+                 'user1_id', 'last_message_at', 'user2_id'),
+        db.Index('ix_conversations_user2_id_last_message_at_user1_id',
+                 'user2_id', 'last_message_at', 'user1_id'),
+    )
+
+    user1_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    user2_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_message_preview = db.Column(db.String(140), nullable=False, default='')
+
+    user1_unread = db.Column(db.Integer, nullable=False, default=0)
+    user2_unread = db.Column(db.Integer, nullable=False, default=0)
+
+    # Id of the last message each user has read, see `save_read_marks`.
+    user1_last_read_id = db.Column(db.Integer, nullable=True)
+    user2_last_read_id = db.Column(db.Integer, nullable=True)
+
+    # Time of the newest message moved to the archive, None if none was.
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+    user1 = db.relationship('User', foreign_keys=[user1_id])
+    user2 = db.relationship('User', foreign_keys=[user2_id])
+
+    def __repr__(self):
+        return f'<Conversation {self.user1_id} <-> {self.user2_id}>'
+
+    @staticmethod
+    def key(user1_id, user2_id):
+        return min(user1_id, user2_id), max(user1_id, user2_id)
+
+    @classmethod
+    def get(cls, user1_id, user2_id):
+        return cls.query.get(cls.key(user1_id, user2_id))
+
+    @classmethod
+    def inbox(cls, user, before=None, limit=20):
+        '''
+        Return a page of at most `limit` conversations of a user, latest first, and the
+        cursor of the next (older) page or None.
+
+        The user is on either side of the pair, each side is read in order from its
+        (user_id, last_message_at, other user_id) index and the two are merged with a
+        UNION ALL, so a page needs no sort and its cost doesn't depend on how many
+        conversations come before it.
+        '''
+        if before is not None:
+            before = Message.parse_cursor(before)
+
+        table = cls.__table__
+        sides = []
+        for mine, other in ((table.c.user1_id, table.c.user2_id),
+                            (table.c.user2_id, table.c.user1_id)):
+            query = select([table, other.label('other_id')]).where(
+                and_(mine == user.id, table.c.last_message_at.isnot(None)))
+            if before is not None:
+                last_message_at, other_id = before
+                # The first condition bounds the index range, the second skips the ties.
+                query = query.where(and_(
+                    table.c.last_message_at <= last_message_at,
+                    or_(table.c.last_message_at < last_message_at, other < other_id)))
+            sides.append(query)
+
+        inbox = union_all(*sides).alias('inbox')
+        conversation = aliased(cls, inbox)
+        # A joinedload would wrap the UNION ALL in a subquery and sort the page again.
+        conversations = db.session.query(conversation).options(
+            db.selectinload(conversation.user1), db.selectinload(conversation.user2)).order_by(
+                inbox.c.last_message_at.desc(), inbox.c.other_id.desc()).limit(limit + 1).all()
+
+        if len(conversations) > limit:
+            conversations = conversations[:limit]
+            return conversations, conversations[-1].cursor(user)
+        return conversations, None
+
+    @classmethod
+    def record_messages(cls, messages, session=None):
+        '''
+        Fold new messages into the summaries of their conversations: the latest one
+        becomes the last message and each is counted as unread for its recipient.
+        Costs one UPDATE (or INSERT) per conversation, not per message.
+        '''
+        session = session or db.session
+
+        summaries = {}
+        for message in messages:
+            key = cls.key(message.sender_id, message.recipient_id)
+            summary = summaries.setdefault(key, {'user1_unread': 0, 'user2_unread': 0})
+            summary['last_message_id'] = message.id
+            summary['last_message_at'] = message.created_at
+            summary['last_message_preview'] = message.body[:140]
+            summary['user1_unread' if message.recipient_id == key[0] else 'user2_unread'] += 1
+
+        table = cls.__table__
+        for (user1_id, user2_id), summary in summaries.items():
+            # Let the database do the arithmetic, so concurrent senders don't lose updates.
+            result = session.execute(table.update().where(
+                and_(table.c.user1_id == user1_id, table.c.user2_id == user2_id)).values(
+                    last_message_id=summary['last_message_id'],
+                    last_message_at=summary['last_message_at'],
+                    last_message_preview=summary['last_message_preview'],
+                    user1_unread=table.c.user1_unread + summary['user1_unread'],
+                    user2_unread=table.c.user2_unread + summary['user2_unread']))
+            if result.rowcount == 0:
+                session.execute(table.insert().values(user1_id=user1_id,
+                                                      user2_id=user2_id,
+                                                      **summary))
+
+    @classmethod
+    def save_read_marks(cls, session, marks):
+        '''
+        Move read marks, given as ((reader_id, other_id), message_id) pairs, with one
+        UPDATE each, see `ReadReceipts`. The reader's unread count becomes the number of
+        messages sent to them after the marked one, an empty index range when it is the
+        latest. Returns the marks that moved.
+
+        A mark only moves forward, and only to a message `other_id` sent to `reader_id`
+        that is still in the table. Other marks, like those of an old tab or of a message
+        that was since archived or deleted, leave the mark and the count as they are.
+        '''
+        table = cls.__table__
+        messages = Message.__table__
+        current = messages.alias('current')
+
+        moved = []
+        for (reader_id, other_id), message_id in marks:
+            user1_id, user2_id = cls.key(reader_id, other_id)
+            side = 'user1' if reader_id == user1_id else 'user2'
+
+            marked_at = select([messages.c.created_at]).where(
+                and_(messages.c.id == message_id,
+                     messages.c.sender_id == other_id,
+                     messages.c.recipient_id == reader_id)).as_scalar()
+            unread = select([func.count()]).where(
+                and_(messages.c.sender_id == other_id,
+                     messages.c.recipient_id == reader_id,
+                     messages.c.created_at > marked_at)).as_scalar()
+            # The current mark is the same message or a newer one.
+            newer = select([current.c.id]).where(
+                and_(current.c.id == table.c[f'{side}_last_read_id'],
+                     or_(current.c.created_at > marked_at,
+                         and_(current.c.created_at == marked_at, current.c.id >= message_id))))
+
+            result = session.execute(table.update().where(
+                and_(table.c.user1_id == user1_id,
+                     table.c.user2_id == user2_id,
+                     marked_at.isnot(None),
+                     ~exists(newer))).values({
+                         f'{side}_last_read_id': message_id,
+                         f'{side}_unread': unread,
+                     }))
+            if result.rowcount:
+                moved.append(((reader_id, other_id), message_id))
+        return moved
+
+    def other(self, user):
+        return self.user2 if user.id == self.user1_id else self.user1
+
+    def cursor(self, user):
+        ''' Opaque keyset position of the conversation in the inbox of `user`, see `inbox`. '''
+        other_id = self.user2_id if user.id == self.user1_id else self.user1_id
+        return f'{self.last_message_at.isoformat()}_{other_id}'
+
+    def unread(self, user):
+        return self.user1_unread if user.id == self.user1_id else self.user2_unread
+
+    def forget_message(self, message):
+        ''' Undo `record_messages` for a message that is about to be deleted. '''
+        unread = self.user1_unread if message.recipient_id == self.user1_id else self.user2_unread
+        if unread:
+            # The message is unread if it is among the last `unread` ones sent to the recipient.
+            newer = Message.query.filter(
+                Message.sender_id == message.sender_id,
+                Message.recipient_id == message.recipient_id,
+                Message.created_at >= message.created_at).limit(unread + 1).count()
+            if newer <= unread:
+                attribute = ('user1_unread' if message.recipient_id == self.user1_id
+                             else 'user2_unread')
+                setattr(self, attribute, getattr(Conversation, attribute) - 1)
+
+        if self.last_message_id == message.id:
+            messages, _ = Message.history(message.sender_id, message.recipient_id,
+                                          before=message.cursor, limit=1)
+            if messages:
+                self.last_message_id = messages[0].id
+                self.last_message_at = messages[0].created_at
+                self.last_message_preview = messages[0].body[:140]
+            else:
+                self.last_message_id = None
+                self.last_message_at = None
+                self.last_message_preview = ''
+
+    def last_read_id(self, user):
+        return self.user1_last_read_id if user.id == self.user1_id else self.user2_last_read_id
+
 
 class FriendshipRequest(db.Model):
 
     __tablename__ = 'friendship_requests'
+    __table_args__ = (
+        # The primary key lists the sent requests, this lists the received ones.
+        db.Index('ix_friendship_requests_receiving_user_id_requesting_user_id',
+                 'receiving_user_id', 'requesting_user_id'),
+    )
 
     requesting_user_id = db.Column(
         db.Integer,
@@ -52,6 +393,13 @@ class FriendshipRequest(db.Model):
 
 
 class Friendship(db.Model):
+    ''' An undirected friendship, stored once with the smaller user id first. '''
+
+    __table_args__ = (
+        db.CheckConstraint('user1_id < user2_id', name='ck_friendship_user_order'),
+        # The primary key lists the friends with a larger id, this lists the others.
+        db.Index('ix_friendship_user2_id_user1_id', 'user2_id', 'user1_id'),
+    )
 
     user1_id = db.Column(
         db.Integer,
@@ -67,8 +415,34 @@ class Friendship(db.Model):
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    user1 = db.relationship('User', foreign_keys=[user1_id])
+    user2 = db.relationship('User', foreign_keys=[user2_id])
+
+    def __init__(self, user1=None, user2=None, **kwargs):
+        ''' Takes the two users, or user1_id and user2_id, in any order. '''
+        if user1 is not None:
+            kwargs['user1'], kwargs['user2'] = sorted((user1, user2), key=lambda user: user.id)
+        elif 'user1_id' in kwargs:
+            kwargs['user1_id'], kwargs['user2_id'] = self.key(kwargs['user1_id'],
+                                                              kwargs['user2_id'])
+        super().__init__(**kwargs)
+
     def __repr__(self):
-        return f'<Friendship {self.user1} -> {self.user2}>'
+        return f'<Friendship {self.user1_id} <-> {self.user2_id}>'
+
+    @staticmethod
+    def key(user1_id, user2_id):
+        return min(user1_id, user2_id), max(user1_id, user2_id)
+
+    @classmethod
+    def between(cls, user1_id, user2_id):
+        ''' The friendship of two users as a single primary key probe. '''
+        user1_id, user2_id = cls.key(user1_id, user2_id)
+        return cls.query.filter_by(user1_id=user1_id, user2_id=user2_id)
+
+    @classmethod
+    def are_friends(cls, user1, user2):
+        return db.session.query(cls.between(user1.id, user2.id).exists()).scalar()
 
 
 class User(UserMixin, db.Model):
@@ -81,6 +455,9 @@ class User(UserMixin, db.Model):
     about = db.Column(db.String(140), nullable=False, default='')
     image = db.Column(db.String(128), nullable=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Bumped whenever the friends or friendship requests of the user, or their avatars,
+    # change. Cached fragments listing them are keyed on it.
+    graph_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     requested_friendships = db.relationship(
         'FriendshipRequest',
@@ -97,19 +474,6 @@ class User(UserMixin, db.Model):
     aspiring_friends = association_proxy('received_friendships', 'requesting_user')
     desired_friends = association_proxy('requested_friendships', 'receiving_user')
 
-    friendships1 = db.relationship('Friendship',
-                                   foreign_keys='Friendship.user1_id',
-                                   backref='user1',
-                                   lazy='dynamic')
-
-    friendships2 = db.relationship('Friendship',
-                                   foreign_keys='Friendship.user2_id',
-                                   backref='user2',
-                                   lazy='dynamic')
-
-    friends1 = association_proxy('friendships1', 'user2')
-    friends2 = association_proxy('friendships2', 'user1')
-
     sent_messages = db.relationship('Message',
                                     foreign_keys='Message.sender_id',
                                     backref='sender',
@@ -126,41 +490,116 @@ class User(UserMixin, db.Model):
     def get_profile_url(self):
         return url_for('profile', username=self.username)
 
+    def get_image_url(self, size='md'):
+        return avatar_url(self.username, self.image, size)
+
     @property
     def image_url(self):
-        if self.image:
-            return url_for('send_avatar', username=self.username)
-        return url_for('static', filename='images/default-avatar.png')
+        return self.get_image_url()
 
     @property
     def friendships(self):
-        # TODO: BAD!
-        return self.friendships1.all() + self.friendships2.all()
+        return Friendship.query.filter(
+            or_(Friendship.user1_id == self.id, Friendship.user2_id == self.id)).all()
 
     @property
     def friends(self):
-        # TODO: BAD!
-        return self.friends1 + self.friends2
+        return self.friends_query().order_by(User.username).all()
+
+    def friends_query(self):
+        ''' Friends of the user as a single UNION query, ready to be paginated. '''
+        friends1 = User.query.join(Friendship, Friendship.user2_id == User.id).filter(
+            Friendship.user1_id == self.id)
+        friends2 = User.query.join(Friendship, Friendship.user1_id == User.id).filter(
+            Friendship.user2_id == self.id)
+        return friends1.union(friends2)
+
+    def friend_ids(self):
+        query = db.session.query(Friendship.user2_id).filter(
+            Friendship.user1_id == self.id).union_all(
+                db.session.query(Friendship.user1_id).filter(Friendship.user2_id == self.id))
+        return [user_id for user_id, in query]
+
+    def aspiring_friends_query(self):
+        ''' Users who sent the user a friendship request. '''
+        return User.query.join(
+            FriendshipRequest, FriendshipRequest.requesting_user_id == User.id).filter(
+                FriendshipRequest.receiving_user_id == self.id)
+
+    def desired_friends_query(self):
+        ''' Users the user sent a friendship request to. '''
+        return User.query.join(
+            FriendshipRequest, FriendshipRequest.receiving_user_id == User.id).filter(
+                FriendshipRequest.requesting_user_id == self.id)
+
+    def graph_neighbour_ids(self):
+        ''' Ids of the friends of the user and of the users with a request from or to them. '''
+        query = db.session.query(Friendship.user2_id).filter(
+            Friendship.user1_id == self.id).union(
+                db.session.query(Friendship.user1_id).filter(Friendship.user2_id == self.id),
+                db.session.query(FriendshipRequest.receiving_user_id).filter(
+                    FriendshipRequest.requesting_user_id == self.id),
+                db.session.query(FriendshipRequest.requesting_user_id).filter(
+                    FriendshipRequest.receiving_user_id == self.id))
+        return [user_id for user_id, in query]
+
+    @classmethod
+    def bump_graph_versions(cls, user_ids):
+        ''' Invalidate the cached friend fragments of the given users in one UPDATE. '''
+        if user_ids:
+            cls.query.filter(cls.id.in_(user_ids)).update(
+                {cls.graph_version: cls.graph_version + 1}, synchronize_session=False)
+
+    def current_graph_version(self):
+        '''
+        `graph_version` read from the database. The loaded user may come from the cache of a
+        worker that didn't see the last bump.
+        '''
+        return db.session.query(User.graph_version).filter(User.id == self.id).scalar()
+
+    def friendship_statuses(self, users):
+        ''' Map ids of the given users to 'friend', 'requested' or 'received' in one query. '''
+        ids = [user.id for user in users]
+        if not ids:
+            return {}
+
+        query = db.session.query(
+            Friendship.user2_id, literal('friend')).filter(
+                Friendship.user1_id == self.id, Friendship.user2_id.in_(ids)).union_all(
+                    db.session.query(Friendship.user1_id, literal('friend')).filter(
+                        Friendship.user2_id == self.id, Friendship.user1_id.in_(ids)),
+                    db.session.query(FriendshipRequest.receiving_user_id,
+                                     literal('requested')).filter(
+                        FriendshipRequest.requesting_user_id == self.id,
+                        FriendshipRequest.receiving_user_id.in_(ids)),
+                    db.session.query(FriendshipRequest.requesting_user_id,
+                                     literal('received')).filter(
+                        FriendshipRequest.receiving_user_id == self.id,
+                        FriendshipRequest.requesting_user_id.in_(ids)))
+
+        statuses = {}
+        for user_id, status in query:
+            if statuses.get(user_id) != 'friend':
+                statuses[user_id] = status
+        return statuses
 
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return verify_password(self.password, password)
 
-    # def get_friends(self):
-    #     users1 = db.session.query(Friendship.user2).filter(Friendship.user1 == self)
-    #     users2 = db.session.query(Friendship.user1).filter(Friendship.user2 == self)
-    #     return users1.union(users2).all()
+    def password_needs_rehash(self):
+        return needs_rehash(self.password)
 
     @classmethod
     def generate_fake(cls, count=100):
         from faker import Faker
         fake = Faker()
 
+        password = hash_password('pass')
         for i in range(count):
-            user = cls(username=fake.user_name(), about=fake.paragraph())
-            user.set_password('pass')
+            user = cls(username=fake.user_name(), about=fake.paragraph(), password=password)
             db.session.add(user)
             try:
                 db.session.commit()
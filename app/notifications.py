@@ -0,0 +1,35 @@
+from sqlalchemy import event
+
+from .utils import user_room
+
+
+class Notifier:
+    '''
+    Small Socket.IO events to all the sockets of a user, on their own namespace so every
+    page can listen without joining the chat.
+
+    Events describing a database change are pushed with `push` and only sent once the
+    session commits it, a rolled back change is never announced.
+    '''
+
+    def __init__(self, socketio, session, namespace='/notifications'):
+        self.socketio = socketio
+        self.session = session
+        self.namespace = namespace
+
+        event.listen(session, 'after_commit', self.send_pending)
+        event.listen(session, 'after_rollback', self.drop_pending)
+
+    def send(self, user_ids, name, data):
+        for user_id in user_ids:
+            self.socketio.emit(name, data, namespace=self.namespace, room=user_room(user_id))
+
+    def push(self, user_id, name, data):
+        self.session.info.setdefault('notifications', []).append((user_id, name, data))
+
+    def send_pending(self, session):
+        for user_id, name, data in session.info.pop('notifications', ()):
+            self.send([user_id], name, data)
+
+    def drop_pending(self, session):
+        session.info.pop('notifications', None)
@@ -0,0 +1,23 @@
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from . import workers
+
+
+def hash_password(password):
+    '''
+    Hash with PASSWORD_HASH_METHOD in a worker thread. PBKDF2 keeps a core busy for
+    a good part of the request, under eventlet that would stall every socket.
+    '''
+    return workers.run(generate_password_hash, password,
+                       method=current_app.config['PASSWORD_HASH_METHOD'],
+                       salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(pwhash, password):
+    return workers.run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    ''' Whether the hash was made with other parameters than the configured ones. '''
+    return pwhash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
@@ -0,0 +1,296 @@
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class Presence(ABC):
+    '''
+    Registry of the open Socket.IO sessions of every user.
+
+    A user may have any number of sessions (tabs, devices, workers). Every session
+    expires `ttl` seconds after it was added or last sent a heartbeat, so sessions
+    of a crashed worker don't keep their user online forever. `expire` unregisters
+    them, and `start` does it in the background to report the users that went offline.
+    '''
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.thread = None
+
+    @abstractmethod
+    def add(self, user_id, sid):
+        ''' Register a session, return True if the user was offline before. '''
+
+    @abstractmethod
+    def remove(self, user_id, sid):
+        ''' Unregister a session, return True if the user is offline now. '''
+
+    def heartbeat(self, user_id, sid):
+        ''' Keep a session alive, registering it again if it expired, see `add`. '''
+        return self.add(user_id, sid)
+
+    @abstractmethod
+    def sessions(self, user_id):
+        ''' Sids of the live sessions of a user. '''
+
+    @abstractmethod
+    def online(self, user_ids):
+        ''' Return the subset of `user_ids` that have at least one live session. '''
+
+    @abstractmethod
+    def expire(self):
+        '''
+        Unregister the expired sessions and return the ids of the users left without
+        any. Each user is returned once, whichever worker calls it.
+        '''
+
+    def is_online(self, user_id):
+        return bool(self.sessions(user_id))
+
+    def start(self, expired, interval=None):
+        '''
+        Call `expired(user_ids)` with the users returned by `expire`, every `interval`
+        seconds (a third of the ttl by default), in a background thread.
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,
+                                           args=(expired, interval or self.ttl / 3),
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self, expired, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                user_ids = self.expire()
+                if user_ids:
+                    expired(user_ids)
+            except Exception:
+                logger.exception('Could not expire sessions.')
+
+
+class MemoryPresence(Presence):
+    ''' Process local registry, only correct with a single worker. '''
+
+    def __init__(self, ttl=60):
+        super().__init__(ttl)
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def _live(self, user_id, now):
+        sessions = self.users.get(user_id, {})
+        for sid, expires_at in list(sessions.items()):
+            if expires_at <= now:
+                del sessions[sid]
+        return sessions
+
+    def add(self, user_id, sid):
+        now = time.time()
+        with self.lock:
+            sessions = self._live(user_id, now)
+            was_offline = not sessions
+            sessions[sid] = now + self.ttl
+            self.users[user_id] = sessions
+        return was_offline
+
+    def remove(self, user_id, sid):
+        with self.lock:
+            sessions = self._live(user_id, time.time())
+            sessions.pop(sid, None)
+            if not sessions:
+                self.users.pop(user_id, None)
+        return not sessions
+
+    def sessions(self, user_id):
+        with self.lock:
+            return set(self._live(user_id, time.time()))
+
+    def online(self, user_ids):
+        now = time.time()
+        with self.lock:
+            return {user_id for user_id in user_ids if self._live(user_id, now)}
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            offline = {user_id for user_id in self.users if not self._live(user_id, now)}
+            for user_id in offline:
+                del self.users[user_id]
+        return offline
+
+
+class SQLitePresence(Presence):
+    '''
+    Registry shared by all workers on one host through an SQLite file, in the table `name`.
+
+    Meant as a stand-in for Redis when running several workers locally.
+    '''
+
+    def __init__(self, path, ttl=60, name='presence'):
+        super().__init__(ttl)
+        self.name = name
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=5, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {name} ('
+                                f'sid TEXT PRIMARY KEY, '
+                                f'user_id INTEGER NOT NULL, '
+                                f'expires_at REAL NOT NULL)')
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{name}_user_id_expires_at '
+                                f'ON {name} (user_id, expires_at)')
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{name}_expires_at '
+                                f'ON {name} (expires_at)')
+
+    def _count(self, user_id, now):
+        return self.connection.execute(
+            f'SELECT COUNT(*) FROM {self.name} WHERE user_id = ? AND expires_at > ?',
+            (user_id, now)).fetchone()[0]
+
+    def add(self, user_id, sid):
+        now = time.time()
+        with self.lock:
+            was_offline = self._count(user_id, now) == 0
+            self.connection.execute(f'INSERT OR REPLACE INTO {self.name} VALUES (?, ?, ?)',
+                                    (sid, user_id, now + self.ttl))
+        return was_offline
+
+    def remove(self, user_id, sid):
+        # Expired sessions are left to `expire`, which reports their users.
+        with self.lock:
+            self.connection.execute(f'DELETE FROM {self.name} WHERE sid = ?', (sid,))
+            return self._count(user_id, time.time()) == 0
+
+    def sessions(self, user_id):
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT sid FROM {self.name} WHERE user_id = ? AND expires_at > ?',
+                (user_id, time.time())).fetchall()
+        return {sid for sid, in rows}
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        placeholders = ', '.join('?' * len(user_ids))
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT DISTINCT user_id FROM {self.name} '
+                f'WHERE user_id IN ({placeholders}) AND expires_at > ?',
+                (*user_ids, time.time())).fetchall()
+        return {user_id for user_id, in rows}
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            # Taking the write lock first, so two workers can't report the same users.
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.connection.execute(
+                    f'SELECT DISTINCT user_id FROM {self.name} WHERE expires_at <= ?',
+                    (now,)).fetchall()
+                self.connection.execute(f'DELETE FROM {self.name} WHERE expires_at <= ?',
+                                        (now,))
+                offline = {user_id for user_id, in rows if self._count(user_id, now) == 0}
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return offline
+
+
+class RedisPresence(Presence):
+    '''
+    Registry shared by all workers, one sorted set of sid -> expiry per user, and one of
+    user id -> expiry of their last session to find the users that went offline.
+    '''
+
+    # Removes a user whose last session expired, once, returns 1 if it did.
+    EXPIRE_SCRIPT = '''
+        local expires_at = redis.call('ZSCORE', KEYS[1], ARGV[1])
+        if expires_at and tonumber(expires_at) <= tonumber(ARGV[2]) then
+            redis.call('ZREM', KEYS[1], ARGV[1])
+            redis.call('DEL', KEYS[2])
+            return 1
+        end
+        return 0
+    '''
+
+    def __init__(self, url, ttl=60, name='presence'):
+        import redis
+
+        super().__init__(ttl)
+        self.name = name
+        self.redis = redis.Redis.from_url(url)
+        self.expire_user = self.redis.register_script(self.EXPIRE_SCRIPT)
+
+    def key(self, user_id):
+        return f'{self.name}:{user_id}'
+
+    @property
+    def users_key(self):
+        return f'{self.name}:users'
+
+    def add(self, user_id, sid):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.key(user_id), '-inf', now)
+        pipe.zcard(self.key(user_id))
+        pipe.zadd(self.key(user_id), {sid: now + self.ttl})
+        pipe.expire(self.key(user_id), self.ttl)
+        pipe.zadd(self.users_key, {user_id: now + self.ttl})
+        _, count, _, _, _ = pipe.execute()
+        return count == 0
+
+    def remove(self, user_id, sid):
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key(user_id), sid)
+        pipe.zcount(self.key(user_id), time.time(), '+inf')
+        _, count = pipe.execute()
+        if count == 0:
+            self.redis.zrem(self.users_key, user_id)
+        return count == 0
+
+    def sessions(self, user_id):
+        sids = self.redis.zrangebyscore(self.key(user_id), time.time(), '+inf')
+        return {sid.decode() for sid in sids}
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), now, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    def expire(self):
+        now = time.time()
+        offline = set()
+        for user_id in self.redis.zrangebyscore(self.users_key, '-inf', now):
+            user_id = int(user_id)
+            if self.expire_user(keys=[self.users_key, self.key(user_id)], args=[user_id, now]):
+                offline.add(user_id)
+        return offline
+
+
+def create_presence(url, ttl=60, name='presence'):
+    '''
+    Pick a backend from an URL: memory://, sqlite:///path/to/file.db or redis://host.
+    Registries with different names can share a file or a server.
+    '''
+    scheme = urlparse(url).scheme
+
+    if scheme == 'memory':
+        return MemoryPresence(ttl)
+    if scheme == 'sqlite':
+        return SQLitePresence(url[len('sqlite:///'):], ttl, name)
+    if scheme in ('redis', 'rediss'):
+        return RedisPresence(url, ttl, name)
+
+    raise ValueError(f'Unsupported presence backend: {url}')
@@ -0,0 +1,184 @@
+import calendar
+import json
+import logging
+import threading
+import time
+import zlib
+
+from .presence import MemoryPresence
+from .serializers import serialize_message
+
+try:
+    import msgpack
+except ImportError:  # optional, pip install msgpack
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Version of the compact protocol, sockets that never say hello speak version 1.
+COMPACT_PROTOCOL = 2
+
+# Smaller frames aren't worth deflating, they are sent as they are.
+DEFLATE_THRESHOLD = 256
+
+
+def messages_room(user_id, encoding=None):
+    '''
+    Socket.IO room of the /chat sockets of a user that get messages in `encoding`, or as
+    verbose 'message' events when None.
+    '''
+    if encoding is None:
+        return f'user:{user_id}:messages'
+    return f'user:{user_id}:messages:{encoding}'
+
+
+def compact_message(message):
+    ''' [id, sender id, recipient id, created at in epoch seconds, body] '''
+    return [message.id,
+            message.sender_id,
+            message.recipient_id,
+            calendar.timegm(message.created_at.utctimetuple()),
+            message.body]
+
+
+def encode_deflate(frame):
+    data = json.dumps(frame, separators=(',', ':'))
+    if len(data) < DEFLATE_THRESHOLD:
+        return frame
+    return zlib.compress(data.encode())
+
+
+ENCODERS = {
+    'json': lambda frame: frame,
+    'deflate': encode_deflate,
+}
+if msgpack is not None:
+    ENCODERS['msgpack'] = msgpack.packb
+
+
+class ChatSender:
+    '''
+    Deliver chat messages to the /chat sockets of both participants, in the protocol
+    each socket asked for with a 'hello' event.
+
+    Other sockets get a verbose 'message' event per message, as they always did. Compact
+    sockets get 'messages' frames, {'m': [compact_message, ...]}, that refer to users by
+    id. The profiles are sent once, in the answer to hello. Frames are encoded once per
+    encoding and room: 'json' sends the frame as it is, 'deflate' as zlib compressed JSON
+    once it is big enough and 'msgpack' as msgpack, when installed.
+
+    With an `interval` the messages sent meanwhile go out together, in one frame per user.
+
+    Without `encodings` every socket gets 'message' events and nothing is tracked. With
+    them, `subscribe` records the protocol of each socket in a registry per encoding,
+    made by `registry(name)` and shared by the workers like `Presence`, and a message is
+    only encoded and emitted for the protocols its participants' sockets speak.
+    '''
+
+    def __init__(self, socketio, namespace='/chat', encodings=(), interval=0, registry=None):
+        self.socketio = socketio
+        self.namespace = namespace
+        self.encodings = [encoding for encoding in encodings if encoding in ENCODERS]
+        self.interval = interval
+
+        registry = registry or (lambda name: MemoryPresence())
+        self.subscribers = {encoding: registry(f'chat_{encoding or "verbose"}')
+                            for encoding in [None] + self.encodings} if self.encodings else {}
+        # Protocol of the sockets connected to this worker, to refresh and drop them.
+        self.sockets = {}
+
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def negotiate(self, hello):
+        ''' The encoding to use with a client, None if it can't speak the compact protocol. '''
+        if not isinstance(hello, dict) or hello.get('protocol') != COMPACT_PROTOCOL:
+            return None
+        offered = hello.get('encodings')
+        if not isinstance(offered, list):
+            offered = ['json']
+        for encoding in self.encodings:
+            if encoding in offered:
+                return encoding
+        return None
+
+    def subscribe(self, user_id, sid, encoding=None):
+        ''' Deliver messages to a socket in `encoding`, or as 'message' events when None. '''
+        if not self.encodings:
+            return
+        self.unsubscribe(user_id, sid)
+        self.sockets[sid] = encoding
+        self.subscribers[encoding].add(user_id, sid)
+
+    def unsubscribe(self, user_id, sid):
+        if sid in self.sockets:
+            self.subscribers[self.sockets.pop(sid)].remove(user_id, sid)
+
+    def heartbeat(self, user_id, sid):
+        if sid in self.sockets:
+            self.subscribers[self.sockets[sid]].heartbeat(user_id, sid)
+
+    def start(self):
+        ''' Drop the sockets that went away without a disconnect in the background. '''
+        for subscribers in self.subscribers.values():
+            subscribers.start(lambda user_ids: None)
+
+    def prepare(self, message, users):
+        ''' Everything `send` needs, read before a commit expires the message. '''
+        return ({message.sender_id, message.recipient_id},
+                {'type': 'update', 'data': serialize_message(message, users)},
+                compact_message(message))
+
+    def send(self, prepared):
+        user_ids, payload, _ = prepared
+        if self.encodings:
+            user_ids = self.subscribers[None].online(user_ids)
+        for user_id in user_ids:
+            self.socketio.emit('message', payload,
+                               namespace=self.namespace,
+                               room=messages_room(user_id))
+
+        if not self.encodings:
+            return
+        if not self.interval:
+            self.send_frames([prepared])
+            return
+
+        with self.lock:
+            self.pending.append(prepared)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not send a frame of messages.')
+
+    def flush(self):
+        with self.lock:
+            messages, self.pending = self.pending, []
+        if messages:
+            self.send_frames(messages)
+
+    def send_frames(self, messages):
+        rows = {}
+        for user_ids, _, row in messages:
+            for user_id in user_ids:
+                rows.setdefault(user_id, []).append(row)
+
+        for encoding in self.encodings:
+            # Both participants usually get the same frame, encode it once.
+            encoded = {}
+            for user_id in self.subscribers[encoding].online(rows):
+                user_rows = rows[user_id]
+                ids = tuple(row[0] for row in user_rows)
+                if ids not in encoded:
+                    encoded[ids] = ENCODERS[encoding]({'m': user_rows})
+                self.socketio.emit('messages', encoded[ids],
+                                   namespace=self.namespace,
+                                   room=messages_room(user_id, encoding))
@@ -0,0 +1,43 @@
+from .utils import user_room
+from .writebehind import CoalescingWriter
+
+
+class ReadReceipts:
+    '''
+    Read marks, the id of the last message a user has read in a conversation.
+
+    Marks are kept in memory and `save(session, marks)` writes them every `interval`
+    seconds, once per reader and conversation however many messages were read since, and
+    returns those that moved. Once committed the other side's sockets get a 'read'
+    receipt for each of them.
+
+    `before_save` runs before each write, to write the messages the marks point to first.
+    '''
+
+    def __init__(self, db, socketio, save, interval=1.0, namespace='/chat', before_save=None):
+        self.socketio = socketio
+        self.save = save
+        self.namespace = namespace
+        self.before_save = before_save
+        self.writer = CoalescingWriter(db, self.write, interval=interval, after_commit=self.send)
+
+    def mark(self, reader, other, message_id):
+        self.writer.add((reader.id, other.id), (message_id, reader.username))
+
+    def write(self, session, marks):
+        if self.before_save is not None:
+            self.before_save()
+        moved = set(self.save(session, [(key, message_id) for key, (message_id, _) in marks]))
+        return [(key, value) for key, value in marks if (key, value[0]) in moved]
+
+    def send(self, marks):
+        for (_, other_id), (message_id, username) in marks:
+            self.socketio.emit('read', {'user': username, 'message': message_id},
+                               namespace=self.namespace,
+                               room=user_room(other_id))
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
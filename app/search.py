@@ -0,0 +1,271 @@
+from functools import lru_cache
+from itertools import product
+
+from flask import Markup, escape
+from flask_sqlalchemy import Pagination
+from sqlalchemy import and_, event, or_, text
+
+from . import db
+from .cache import TTLCache
+from .models import Message, User
+
+# SQLite FTS5 index over `users.username`, trigrams make it answer substring queries.
+# It stores no copy of the names (external content) and the triggers keep it in sync
+# with every write, including bulk Core inserts that skip the ORM.
+USERS_SEARCH_DDL = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS users_search
+       USING fts5(username, content='users', content_rowid='id', tokenize='trigram')''',
+    '''CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+         INSERT INTO users_search(rowid, username) VALUES (new.id, new.username);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+         INSERT INTO users_search(users_search, rowid, username)
+         VALUES ('delete', old.id, old.username);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username ON users BEGIN
+         INSERT INTO users_search(users_search, rowid, username)
+         VALUES ('delete', old.id, old.username);
+         INSERT INTO users_search(rowid, username) VALUES (new.id, new.username);
+       END''',
+    "INSERT INTO users_search(users_search) VALUES ('rebuild')",
+]
+
+USERS_SEARCH_DROP = [
+    'DROP TRIGGER IF EXISTS users_search_update',
+    'DROP TRIGGER IF EXISTS users_search_delete',
+    'DROP TRIGGER IF EXISTS users_search_insert',
+    'DROP TABLE IF EXISTS users_search',
+]
+
+# SQLite FTS5 index over `messages.body`, with the participants of every message as
+# `u<id>` tokens: a search ANDs the words with the user's token, so it only walks the
+# messages of that user. Its content is a view over `messages`, nothing is stored twice.
+MESSAGES_SEARCH_DDL = [
+    '''CREATE VIEW IF NOT EXISTS messages_search_content AS
+       SELECT id, body, 'u' || sender_id || ' u' || recipient_id AS participants
+       FROM messages''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_search
+       USING fts5(body, participants, content='messages_search_content', content_rowid='id')''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+         INSERT INTO messages_search(rowid, body, participants)
+         VALUES (new.id, new.body, 'u' || new.sender_id || ' u' || new.recipient_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN
+         INSERT INTO messages_search(messages_search, rowid, body, participants)
+         VALUES ('delete', old.id, old.body, 'u' || old.sender_id || ' u' || old.recipient_id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_search_update
+       AFTER UPDATE OF body, sender_id, recipient_id ON messages BEGIN
+         INSERT INTO messages_search(messages_search, rowid, body, participants)
+         VALUES ('delete', old.id, old.body, 'u' || old.sender_id || ' u' || old.recipient_id);
+         INSERT INTO messages_search(rowid, body, participants)
+         VALUES (new.id, new.body, 'u' || new.sender_id || ' u' || new.recipient_id);
+       END''',
+    "INSERT INTO messages_search(messages_search) VALUES ('rebuild')",
+]
+
+MESSAGES_SEARCH_DROP = [
+    'DROP TRIGGER IF EXISTS messages_search_update',
+    'DROP TRIGGER IF EXISTS messages_search_delete',
+    'DROP TRIGGER IF EXISTS messages_search_insert',
+    'DROP TABLE IF EXISTS messages_search',
+    'DROP VIEW IF EXISTS messages_search_content',
+]
+
+# Marks around the matches in snippets, replaced once the rest of the text is escaped.
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+SNIPPET_TOKENS = 16
+
+# The trigram tokenizer can't match anything shorter than this.
+MIN_TRIGRAM_LENGTH = 3
+
+# Message search counts are only shown as page links, so they may be a little stale.
+counts = TTLCache(maxsize=1024, ttl=60)
+
+
+def supports_user_search(connection):
+    ''' FTS5 with the trigram tokenizer needs SQLite 3.34. '''
+    dialect = connection.dialect
+    return dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 34)
+
+
+def create_user_search(connection):
+    for statement in USERS_SEARCH_DDL:
+        connection.execute(text(statement))
+
+
+def drop_user_search(connection):
+    for statement in USERS_SEARCH_DROP:
+        connection.execute(text(statement))
+
+
+@event.listens_for(User.__table__, 'after_create')
+def on_users_created(table, connection, **kwargs):
+    # `db.create_all()` builds the index too, migrations do it in their own revision.
+    if supports_user_search(connection):
+        create_user_search(connection)
+
+
+@event.listens_for(User.__table__, 'before_drop')
+def on_users_dropped(table, connection, **kwargs):
+    if supports_user_search(connection):
+        drop_user_search(connection)
+
+
+def supports_message_search(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def create_message_search(connection):
+    for statement in MESSAGES_SEARCH_DDL:
+        connection.execute(text(statement))
+
+
+def drop_message_search(connection):
+    for statement in MESSAGES_SEARCH_DROP:
+        connection.execute(text(statement))
+
+
+def rebuild_search(connection):
+    ''' Create the missing indexes and rebuild all of them from their tables. '''
+    if supports_user_search(connection):
+        create_user_search(connection)
+        connection.execute(text("INSERT INTO users_search(users_search) VALUES ('optimize')"))
+    if supports_message_search(connection):
+        create_message_search(connection)
+        connection.execute(
+            text("INSERT INTO messages_search(messages_search) VALUES ('optimize')"))
+    has_user_search.cache_clear()
+    has_message_search.cache_clear()
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def on_messages_created(table, connection, **kwargs):
+    if supports_message_search(connection):
+        create_message_search(connection)
+
+
+@event.listens_for(Message.__table__, 'before_drop')
+def on_messages_dropped(table, connection, **kwargs):
+    if supports_message_search(connection):
+        drop_message_search(connection)
+
+
+@lru_cache(maxsize=None)
+def has_user_search(engine):
+    return supports_user_search(engine) and engine.has_table('users_search')
+
+
+@lru_cache(maxsize=None)
+def has_message_search(engine):
+    return supports_message_search(engine) and engine.has_table('messages_search')
+
+
+def search_users(query, exclude, after=None, limit=10):
+    '''
+    Users whose username contains `query`, all users if it's empty, without `exclude`,
+    by username: up to `limit` after the username `after`, and the cursor of the next
+    page or None. Short queries are answered as prefixes from the username index, longer
+    ones from the trigram index.
+    '''
+    query = (query or '').strip()
+
+    if query and len(query) >= MIN_TRIGRAM_LENGTH and has_user_search(db.engine):
+        users = search_users_indexed(query, exclude, after, limit)
+    else:
+        qs = User.query.filter(User.id != exclude.id)
+        if len(query) >= MIN_TRIGRAM_LENGTH:
+            qs = qs.filter(User.username.contains(query))
+        elif query:
+            qs = qs.filter(prefix_filter(query))
+        if after is not None:
+            qs = qs.filter(User.username > after)
+        users = qs.order_by(User.username).limit(limit + 1).all()
+
+    if len(users) > limit:
+        users = users[:limit]
+        return users, users[-1].username
+    return users, None
+
+
+def search_users_indexed(query, exclude, after, limit):
+    # A phrase, so the user's input is never parsed as FTS5 syntax.
+    phrase = '"{}"'.format(query.replace('"', '""'))
+    return (User.query
+            .from_statement(text(
+                'SELECT users.* FROM users_search JOIN users ON users.id = users_search.rowid '
+                'WHERE users_search MATCH :phrase AND users.id != :exclude '
+                'AND (:after IS NULL OR users.username > :after) '
+                'ORDER BY users.username LIMIT :limit'))
+            .params(phrase=phrase, exclude=exclude.id, after=after, limit=limit + 1)
+            .all())
+
+
+def prefix_filter(prefix):
+    '''
+    Case insensitive `username LIKE 'prefix%'` as ranges on the unique username index,
+    one per spelling of the prefix, where LIKE would scan the table.
+    '''
+    spellings = {''.join(chars) for chars in product(*({c.lower(), c.upper()} for c in prefix))}
+    return or_(*(and_(User.username >= spelling, User.username < spelling + '\U0010ffff')
+                 for spelling in sorted(spellings)))
+
+
+def search_messages(query, user, other=None, page=1, per_page=20):
+    '''
+    Page of the messages of `user`, only those with `other` if given, that contain every
+    word of `query`, best matches first. Items are (message, HTML snippet) pairs.
+    '''
+    words = (query or '').split()
+    if not words:
+        return Pagination(None, page, per_page, 0, [])
+    if not has_message_search(db.engine):
+        return search_messages_unindexed(words, user, other, page, per_page)
+
+    # Words as phrases, so the user's input is never parsed as FTS5 syntax.
+    phrases = ' AND '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+    participants = ' AND '.join(sorted({f'u{user.id}', f'u{(other or user).id}'}))
+    match = f'body : ({phrases}) AND participants : ({participants})'
+
+    total = counts.get_or_set(('messages', match), lambda: db.session.execute(
+        text('SELECT count(*) FROM messages_search WHERE messages_search MATCH :match'),
+        {'match': match}).scalar())
+
+    rows = db.session.execute(text(
+        'SELECT rowid, snippet(messages_search, 0, :start, :end, :ellipsis, :tokens) '
+        'FROM messages_search WHERE messages_search MATCH :match '
+        'ORDER BY rank LIMIT :limit OFFSET :offset'), {
+            'match': match,
+            'start': SNIPPET_START,
+            'end': SNIPPET_END,
+            'ellipsis': '\u2026',
+            'tokens': SNIPPET_TOKENS,
+            'limit': per_page,
+            'offset': (page - 1) * per_page,
+        }).fetchall()
+
+    messages = Message.query.filter(Message.id.in_([row[0] for row in rows])).all()
+    messages = {message.id: message for message in messages}
+    items = [(messages[message_id], highlight(snippet))
+             for message_id, snippet in rows if message_id in messages]
+    return Pagination(None, page, per_page, total, items)
+
+
+def search_messages_unindexed(words, user, other, page, per_page):
+    if other is None:
+        qs = Message.query.filter(
+            or_(Message.sender_id == user.id, Message.recipient_id == user.id))
+    else:
+        qs = Message.query.filter(
+            or_(and_(Message.sender_id == user.id, Message.recipient_id == other.id),
+                and_(Message.sender_id == other.id, Message.recipient_id == user.id)))
+    qs = qs.filter(*(Message.body.contains(word) for word in words))
+
+    pagination = qs.order_by(Message.created_at.desc()).paginate(page, per_page, error_out=False)
+    pagination.items = [(message, escape(message.body)) for message in pagination.items]
+    return pagination
+
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace(SNIPPET_START, '<mark>').replace(
+        SNIPPET_END, '</mark>'))
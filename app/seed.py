@@ -0,0 +1,238 @@
+'''
+Reproducible load-test datasets: users, a power-law friendship graph, pending requests
+and message histories, written with Core executemany inserts.
+
+Rows are generated in chunks, each from its own random generator seeded with the dataset
+seed and the chunk number, so the same options give the same rows whatever the number
+of processes generating them.
+'''
+import multiprocessing
+import random
+from array import array
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate, count
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import and_, func, select, text
+from sqlalchemy.dialects import postgresql
+
+from .models import Friendship, FriendshipRequest, Message, User
+from .passwords import hash_password
+
+# Fixed, so timestamps don't depend on the day the dataset was built.
+EPOCH = datetime(2021, 1, 1)
+SPAN = timedelta(days=365)
+
+WORDS = '''
+lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt
+ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco
+laboris nisi aliquip ex ea commodo consequat duis aute irure in reprehenderit voluptate
+velit esse cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non proident
+'''.split()
+
+# Exponent of the popularity of users, a few have most of the friends.
+ALPHA = 0.8
+
+# Shared with forked workers instead of being pickled into every task.
+weights = None
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choices(WORDS, k=words)).capitalize()
+
+
+def timestamp(rng, start=EPOCH, span=SPAN):
+    return start + timedelta(seconds=rng.random() * span.total_seconds())
+
+
+def popularity(count):
+    ''' Cumulative weights of `count` users whose popularity follows a power law. '''
+    return array('d', accumulate((rank + 1) ** -ALPHA for rank in range(count)))
+
+
+def pick(rng, cumulative):
+    return bisect(cumulative, rng.random() * cumulative[-1])
+
+
+def degree(rng, mean):
+    ''' Pareto distributed number of friends with the given mean. '''
+    shape = 2.0
+    return int(rng.paretovariate(shape) * mean * (shape - 1) / shape)
+
+
+def username_prefix(connection, first_id):
+    '''
+    A prefix no username starts with, so seeded names, the prefix and the user id, can't
+    be taken already: 'user' in a new database, 'user<first_id>_1_' and so on after that.
+    '''
+    username = User.__table__.c.username
+    for attempt in count():
+        prefix = f'user{first_id}_{attempt}_' if attempt else 'user'
+        taken = connection.execute(select([username]).where(
+            and_(username >= prefix, username < prefix + '\U0010ffff')).limit(1)).first()
+        if taken is None:
+            return prefix
+
+
+def generate_users(seed, chunk, first_id, start, stop, password, prefix='user'):
+    rng = random.Random(f'{seed}:users:{chunk}')
+    return [{
+        'id': first_id + n,
+        'username': f'{prefix}{first_id + n}',
+        'password': password,
+        'about': sentence(rng, rng.randint(3, 15))[:140],
+        'created_at': timestamp(rng),
+    } for n in range(start, stop)]
+
+
+def generate_friends(seed, chunk, first_id, start, stop, options):
+    '''
+    Friendships started by users [start, stop), each to users picked by popularity,
+    the requests they sent, and the messages of some of their friendships.
+    '''
+    rng = random.Random(f'{seed}:friends:{chunk}')
+    friendships, requests, messages = [], [], []
+
+    for n in range(start, stop):
+        user_id = first_id + n
+
+        for _ in range(degree(rng, options['friends'] / 2)):
+            friend_id = first_id + pick(rng, weights)
+            if friend_id == user_id:
+                continue
+            created_at = timestamp(rng)
+            friendships.append({
+                'user1_id': min(user_id, friend_id),
+                'user2_id': max(user_id, friend_id),
+                'created_at': created_at,
+            })
+
+            if rng.random() < options['conversations']:
+                at = created_at
+                for _ in range(int(rng.expovariate(1 / options['messages'])) + 1):
+                    at += timedelta(minutes=rng.expovariate(1 / 30))
+                    sender, recipient = rng.sample((user_id, friend_id), 2)
+                    messages.append({
+                        'sender_id': sender,
+                        'recipient_id': recipient,
+                        'body': sentence(rng, rng.randint(1, 20)),
+                        'created_at': at,
+                    })
+
+        sent = int(rng.expovariate(1 / options['requests'])) if options['requests'] else 0
+        for _ in range(sent):
+            receiving_id = first_id + pick(rng, weights)
+            if receiving_id != user_id:
+                requests.append({'requesting_user_id': user_id,
+                                 'receiving_user_id': receiving_id})
+
+    return friendships, requests, messages
+
+
+def call(args):
+    function, *args = args
+    return function(*args)
+
+
+def insert_ignore(table, dialect):
+    ''' INSERT of `table` that skips the rows already there, in the syntax of `dialect`. '''
+    if dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if dialect.name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    if dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    raise ValueError(f'Unsupported database for seeding: {dialect.name}')
+
+
+def chunks(count, size):
+    for chunk, start in enumerate(range(0, count, size)):
+        yield chunk, start, min(start + size, count)
+
+
+def build(db, users, friends=20, requests=2, conversations=0.2, messages=20, seed=0,
+          processes=None, chunk_size=10000, password='password', log=print):
+    '''
+    Add `users` users with `friends` friends and `requests` pending requests on average.
+    A `conversations` share of the friendships has `messages` messages on average. All
+    seeded users have the same password.
+    '''
+    global weights
+
+    options = {'friends': friends, 'requests': requests, 'conversations': conversations,
+               'messages': messages}
+    processes = processes or multiprocessing.cpu_count()
+    engine = db.engine
+
+    # Ids are assigned here, so friendships can be generated without reading users back.
+    with engine.connect() as connection:
+        first_id = connection.execute(
+            select([func.coalesce(func.max(User.id), 0) + 1])).scalar()
+        last_message_id = connection.execute(
+            select([func.coalesce(func.max(Message.id), 0)])).scalar()
+        prefix = username_prefix(connection, first_id)
+
+    # Hashed once for everybody, hashing per user would take longer than the rest.
+    pwhash = hash_password(password)
+
+    weights = popularity(users)
+    insert_friendships = insert_ignore(Friendship.__table__, engine.dialect)
+    insert_requests = insert_ignore(FriendshipRequest.__table__, engine.dialect)
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context('fork').Pool(processes)
+    else:
+        # Workers have to fork to inherit `weights`, without it everything runs here.
+        pool = ThreadPool(1)
+    with pool:
+        tasks = [(generate_users, seed, chunk, first_id, start, stop, pwhash, prefix)
+                 for chunk, start, stop in chunks(users, chunk_size)]
+        for rows in pool.imap(call, tasks):
+            with engine.begin() as connection:
+                connection.execute(User.__table__.insert(), rows)
+            log(f'users: {rows[-1]["id"] - first_id + 1}/{users}')
+
+        tasks = [(generate_friends, seed, chunk, first_id, start, stop, options)
+                 for chunk, start, stop in chunks(users, chunk_size)]
+        totals = [0, 0, 0]
+        for friendship_rows, request_rows, message_rows in pool.imap(call, tasks):
+            with engine.begin() as connection:
+                # Popular users are picked more than once, the first pick wins.
+                if friendship_rows:
+                    connection.execute(insert_friendships, friendship_rows)
+                if request_rows:
+                    connection.execute(insert_requests, request_rows)
+                if message_rows:
+                    connection.execute(Message.__table__.insert(), message_rows)
+            for i, rows in enumerate((friendship_rows, request_rows, message_rows)):
+                totals[i] += len(rows)
+            log('friendships: {}, requests: {}, messages: {}'.format(*totals))
+
+    with engine.begin() as connection:
+        # Requests between users that became friends are not pending anymore.
+        connection.execute(text('''
+            DELETE FROM friendship_requests
+            WHERE requesting_user_id >= :first AND EXISTS (
+                SELECT 1 FROM friendship
+                WHERE (user1_id = requesting_user_id AND user2_id = receiving_user_id)
+                   OR (user1_id = receiving_user_id AND user2_id = requesting_user_id))
+        '''), first=first_id)
+        connection.execute(text('''
+            INSERT INTO conversations (user1_id, user2_id, last_message_id, last_message_at,
+                                       last_message_preview, user1_unread, user2_unread)
+            SELECT pairs.user1_id, pairs.user2_id, messages.id, messages.created_at,
+                   substr(messages.body, 1, 140), 0, 0
+            FROM (
+                SELECT CASE WHEN sender_id < recipient_id THEN sender_id ELSE recipient_id END
+                           AS user1_id,
+                       CASE WHEN sender_id < recipient_id THEN recipient_id ELSE sender_id END
+                           AS user2_id,
+                       max(id) AS last_message_id
+                FROM messages
+                WHERE id > :after
+                GROUP BY 1, 2
+            ) AS pairs
+            JOIN messages ON messages.id = pairs.last_message_id
+        '''), after=last_message_id)
+    log('conversations: done')
@@ -0,0 +1,51 @@
+from functools import lru_cache
+
+from flask import url_for
+
+from .avatars import avatar_filename, is_avatar_key
+
+
+@lru_cache(maxsize=4096)
+def avatar_endpoint(username, image, size='md'):
+    '''
+    Endpoint and arguments of an avatar URL, worked out once per (username, image, size).
+    They name the stored file, so it is served without a query and changes with the image.
+    '''
+    if is_avatar_key(image):
+        return 'avatar', (('filename', avatar_filename(image, size)),)
+    if image:
+        return 'send_avatar', (('username', username),)
+    return 'static', (('filename', 'images/default-avatar.png'),)
+
+
+def avatar_url(username, image, size='md'):
+    # The URL itself depends on the request (script root, SERVER_NAME), so it isn't cached.
+    endpoint, values = avatar_endpoint(username, image, size)
+    return url_for(endpoint, **dict(values))
+
+
+def serialize_user(user):
+    return {
+        'username': user.username,
+        'imageUrl': avatar_url(user.username, user.image, 'sm'),
+    }
+
+
+def serialize_users(*users):
+    return {user.id: serialize_user(user) for user in users}
+
+
+def serialize_message(message, users):
+    '''
+    Payload of a message, shared by the chat page, the history endpoint and the socket.
+
+    `users` maps the ids of both participants to `serialize_user` payloads, so nothing
+    is loaded from the database here.
+    '''
+    return {
+        'sender': users[message.sender_id],
+        'recipient': users[message.recipient_id],
+        'body': message.body,
+        'createdAt': message.formatted_created_at,
+        'id': message.id,
+    }
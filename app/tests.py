@@ -1,6 +1,445 @@
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
 import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import app, db
+from .archive import Compactor, MessageArchive
+from .cache import Cache, TTLCache
+from .models import Conversation, Message, User
+from .presence import MemoryPresence, SQLitePresence
+from .search import search_users
+from .seed import username_prefix
+from .serializers import avatar_url
+from .writebehind import BatchWriter
+
+NOW = datetime(2026, 10, 18, 12, 0)
 
 
 @pytest.fixture
-def client():
-    pass
+def engine(tmp_path):
+    '''
+    A database with alice and bob, and one message between them 400, 100, 50 and 1 days
+    ago, with their conversation.
+    '''
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    db.metadata.create_all(engine)
+    engine.execute(User.__table__.insert(), [
+        {'id': 1, 'username': 'alice', 'password': 'x'},
+        {'id': 2, 'username': 'bob', 'password': 'x'},
+    ])
+    engine.execute(Message.__table__.insert(), [
+        {'id': days, 'sender_id': 1 + days % 2, 'recipient_id': 2 - days % 2,
+         'body': f'{days} days ago', 'created_at': NOW - timedelta(days=days)}
+        for days in (400, 100, 50, 1)
+    ])
+    engine.execute(Conversation.__table__.insert(), {'user1_id': 1, 'user2_id': 2})
+    return engine
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    ''' The app's session on an empty database. '''
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_DATABASE_URI',
+                        f'sqlite:///{tmp_path / "app.db"}')
+    with app.app_context():
+        db.create_all()
+        yield db.session
+        db.session.remove()
+
+
+def compact(engine, archive, **kwargs):
+    compactor = Compactor(SimpleNamespace(engine=engine), archive, Message.__table__,
+                          Conversation.__table__, **kwargs)
+    while compactor.run_once(NOW):
+        pass
+    return compactor
+
+
+def hot_ids(engine):
+    return sorted(id for id, in engine.execute(select([Message.id])))
+
+
+def archived_ids(archive):
+    return sorted(row[0] for row in archive.history(1, 2))
+
+
+def test_retention_deletes_hot_messages(engine, tmp_path):
+    archive = MessageArchive(tmp_path / 'archive')
+    compactor = compact(engine, archive, retention=timedelta(days=30))
+
+    assert hot_ids(engine) == [1]
+    assert archived_ids(archive) == []
+    assert compactor.moved == 3
+
+
+def test_archive_after_and_retention(engine, tmp_path):
+    archive = MessageArchive(tmp_path / 'archive')
+    compact(engine, archive, archive_after=timedelta(days=10), retention=timedelta(days=200))
+
+    assert hot_ids(engine) == [1]
+    assert archived_ids(archive) == [50, 100]
+    archived_at, = engine.execute(select([Conversation.archived_at])).fetchone()
+    assert archived_at == NOW - timedelta(days=50)
+
+
+def test_retention_is_applied_before_archiving(engine, tmp_path):
+    archive = MessageArchive(tmp_path / 'archive')
+    compact(engine, archive, archive_after=timedelta(days=200), retention=timedelta(days=30))
+
+    assert hot_ids(engine) == [1]
+    assert archived_ids(archive) == []
+
+
+def test_retention_drops_archived_months(engine, tmp_path):
+    archive = MessageArchive(tmp_path / 'archive')
+    compact(engine, archive, hot_limit=1)
+    assert archived_ids(archive) == [50, 100, 400]
+
+    compact(engine, archive, retention=timedelta(days=60))
+    assert archived_ids(archive) == [50]
+    assert hot_ids(engine) == [1]
+
+
+def summary(engine):
+    c = Conversation.__table__
+    return tuple(engine.execute(select([c.c.last_message_id, c.c.user1_unread,
+                                        c.c.user2_unread, c.c.archived_at])).fetchone())
+
+
+def test_retention_updates_unread_counts(engine, tmp_path):
+    engine.execute(Conversation.__table__.update().values(
+        last_message_id=1, last_message_at=NOW - timedelta(days=1), user1_unread=1,
+        user2_unread=3))
+    compact(engine, MessageArchive(tmp_path / 'archive'), retention=timedelta(days=60))
+
+    # Bob had 3 unread messages, 400 and 100 days old ones expired.
+    assert summary(engine) == (1, 1, 1, None)
+
+
+def test_retention_forgets_the_last_message(engine, tmp_path):
+    engine.execute(Conversation.__table__.update().values(
+        last_message_id=1, last_message_at=NOW - timedelta(days=1), user1_unread=1))
+    compact(engine, MessageArchive(tmp_path / 'archive'), retention=timedelta(hours=1))
+
+    assert hot_ids(engine) == []
+    assert summary(engine) == (None, 0, 0, None)
+
+
+def test_retention_forgets_dropped_months(engine, tmp_path):
+    archive = MessageArchive(tmp_path / 'archive')
+    engine.execute(Message.__table__.delete().where(Message.id == 1))
+    engine.execute(Conversation.__table__.update().values(
+        last_message_id=50, last_message_at=NOW - timedelta(days=50), user2_unread=1))
+    compact(engine, archive, archive_after=timedelta(days=10))
+    assert hot_ids(engine) == []
+    assert summary(engine)[3] == NOW - timedelta(days=50)
+
+    compact(engine, archive, retention=timedelta(days=20))
+
+    assert archived_ids(archive) == []
+    assert summary(engine) == (None, 0, 0, None)
+
+
+def test_archive_sees_segments_of_other_workers(engine, tmp_path):
+    archive = MessageArchive(tmp_path / 'archive')
+    other = MessageArchive(tmp_path / 'archive')
+    assert archived_ids(other) == []
+
+    compact(engine, archive, hot_limit=1)
+    assert archived_ids(other) == [50, 100, 400]
+
+
+def test_read_marks_only_move_forward(engine):
+    session = Session(bind=engine)
+    conversation = Conversation.__table__
+    session.execute(conversation.update().values(user2_unread=3))
+
+    def save(message_id):
+        moved = Conversation.save_read_marks(session, [((2, 1), message_id)])
+        return bool(moved), tuple(session.execute(
+            select([conversation.c.user2_last_read_id, conversation.c.user2_unread])).fetchone())
+
+    assert save(100) == (True, (100, 1))
+    # Older, sent by the reader, or not in the table: nothing changes.
+    assert save(400) == (False, (100, 1))
+    assert save(1) == (False, (100, 1))
+    assert save(999) == (False, (100, 1))
+    assert save(100) == (False, (100, 1))
+    assert save(50) == (True, (50, 0))
+
+
+def add_users(session, *usernames):
+    users = [User(username=username, password='x') for username in usernames]
+    session.add_all(users)
+    session.commit()
+    return users
+
+
+def save_messages(session, *messages):
+    ''' Save (id, sender, recipient, minutes after NOW) messages like `BatchWriter` does. '''
+    Message.save_batch(session, [
+        Message(id=id, sender_id=sender.id, recipient_id=recipient.id, body=f'message {id}',
+                created_at=NOW + timedelta(minutes=minutes))
+        for id, sender, recipient, minutes in messages
+    ])
+    session.commit()
+
+
+def test_record_messages_counts_unread(session):
+    alice, bob = add_users(session, 'alice', 'bob')
+    save_messages(session, (1, alice, bob, 0), (2, bob, alice, 1), (3, bob, alice, 2))
+
+    conversation = Conversation.get(alice.id, bob.id)
+    assert conversation.last_message_id == 3
+    assert conversation.last_message_preview == 'message 3'
+    assert (conversation.unread(alice), conversation.unread(bob)) == (2, 1)
+
+
+def test_forget_message(session):
+    alice, bob = add_users(session, 'alice', 'bob')
+    save_messages(session, (1, alice, bob, 0), (2, bob, alice, 1), (3, bob, alice, 2))
+    conversation = Conversation.get(alice.id, bob.id)
+
+    # The last message, unread by alice: the previous one takes its place.
+    conversation.forget_message(Message.query.get(3))
+    session.delete(Message.query.get(3))
+    assert (conversation.last_message_id, conversation.last_message_preview) == (2, 'message 2')
+    assert conversation.unread(alice) == 1
+
+    # Bob's only unread message, which isn't the last one.
+    conversation.forget_message(Message.query.get(1))
+    session.delete(Message.query.get(1))
+    session.commit()
+    assert conversation.last_message_id == 2
+    assert (conversation.unread(alice), conversation.unread(bob)) == (1, 0)
+
+
+def test_inbox_pages_both_sides_latest_first(session):
+    bob, alice, carol, dave, erin = add_users(session, 'bob', 'alice', 'carol', 'dave', 'erin')
+    # Alice is user2 of the conversation with bob and user1 of the others, and the
+    # conversations with carol and dave end at the same time.
+    save_messages(session, (1, bob, alice, 0), (2, alice, carol, 2), (3, dave, alice, 2),
+                  (4, erin, alice, 1))
+    # A conversation without messages left isn't listed.
+    session.add(Conversation(user1_id=alice.id, user2_id=add_users(session, 'frank')[0].id))
+    session.commit()
+
+    pages, before = [], None
+    while True:
+        conversations, before = Conversation.inbox(alice, before=before, limit=1)
+        pages.append([conversation.other(alice).username for conversation in conversations])
+        if before is None:
+            break
+    assert pages == [['dave'], ['carol'], ['erin'], ['bob']]
+
+    conversations, before = Conversation.inbox(alice, limit=3)
+    assert [conversation.last_message_id for conversation in conversations] == [3, 2, 4]
+    assert Conversation.inbox(alice, before=before)[0][0].last_message_id == 1
+
+
+def test_history_pages_with_keyset_cursor(session):
+    alice, bob, carol = add_users(session, 'alice', 'bob', 'carol')
+    # Messages 3 and 4 were sent at the same time, message 5 belongs to another chat.
+    save_messages(session, (1, alice, bob, 0), (2, bob, alice, 1), (3, alice, bob, 2),
+                  (4, bob, alice, 2), (5, alice, carol, 2), (6, bob, alice, 3))
+
+    pages, before = [], None
+    while True:
+        messages, before = Message.history(alice.id, bob.id, before=before, limit=2)
+        pages.append([message.id for message in messages])
+        if before is None:
+            break
+    assert pages == [[4, 6], [2, 3], [1]]
+
+    assert Message.parse_cursor(Message.query.get(3).cursor) == (NOW + timedelta(minutes=2), 3)
+    with pytest.raises(ValueError):
+        Message.parse_cursor('yesterday')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(time, 'time', lambda: clock.now)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def presence(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryPresence(ttl=60)
+    return SQLitePresence(str(tmp_path / 'presence.db'), ttl=60)
+
+
+def test_presence_sessions(presence, clock):
+    assert presence.add(1, 'a') is True
+    assert presence.add(1, 'b') is False
+    assert presence.online([1, 2]) == {1}
+    assert presence.remove(1, 'a') is False
+    assert presence.remove(1, 'b') is True
+    assert presence.online([1]) == set()
+
+
+def test_presence_expiry_reports_offline_users(presence, clock):
+    presence.add(1, 'a')
+    presence.add(2, 'b')
+    clock.now += 30
+    presence.heartbeat(2, 'b')
+    clock.now += 40
+
+    assert presence.online([1, 2]) == {2}
+    assert presence.expire() == {1}
+    assert presence.expire() == set()
+    # The expired session comes back with its next heartbeat.
+    assert presence.heartbeat(1, 'a') is True
+
+
+def test_sqlite_presence_expiry_is_reported_once(tmp_path, clock):
+    workers = [SQLitePresence(str(tmp_path / 'presence.db'), ttl=60) for _ in range(2)]
+    workers[0].add(1, 'a')
+    workers[1].add(1, 'b')
+    workers[1].add(2, 'c')
+    clock.now += 61
+    workers[0].add(2, 'c')
+
+    # Removing a session leaves the expired ones of other users to `expire`.
+    assert workers[1].remove(3, 'd') is True
+    assert workers[1].expire() == {1}
+    assert workers[0].expire() == set()
+
+
+def test_cache_keeps_stale_loads_out():
+    cache = TTLCache()
+    generation = cache.generation()
+    # The user changes and is dropped from the cache while the old row is being loaded.
+    cache.delete('user:1')
+    cache.set('user:1', 'old', generation)
+    assert cache.get('user:1') is None
+
+    cache.set('user:1', 'new', cache.generation())
+    assert cache.get('user:1') == 'new'
+
+
+def test_cache_clear_changes_the_generation():
+    cache = TTLCache()
+    generation = cache.generation()
+    cache.clear()
+    cache.set('user:1', 'old', generation)
+    assert cache.get('user:1') is None
+
+
+def test_cache_is_abstract():
+    with pytest.raises(TypeError):
+        Cache()
+
+
+class FakeSession:
+
+    def __init__(self, written):
+        self.written = written
+        self.pending = []
+
+    def commit(self):
+        self.written.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+def batch_writer(fail, **kwargs):
+    '''
+    A writer that records what it committed, `fail(item)` returns the error writing a
+    batch with that item raises, or None.
+    '''
+    written = []
+
+    def handler(session, items):
+        for item in items:
+            error = fail(item)
+            if error is not None:
+                raise error
+        session.pending.extend(items)
+
+    db = SimpleNamespace(create_session=lambda options: lambda: FakeSession(written))
+    return BatchWriter(db, handler, size=10, interval=3600, **kwargs), written
+
+
+def test_batch_writer_retries_transient_errors():
+    down = True
+    writer, written = batch_writer(lambda item: RuntimeError('database is locked') if down
+                                   else None)
+    writer.add(1)
+    writer.add(2)
+    writer.flush()
+    assert (written, writer.items) == ([], [1, 2])
+
+    down = False
+    writer.add(3)
+    writer.flush()
+    assert (written, writer.items, list(writer.dead_letters)) == ([1, 2, 3], [], [])
+
+
+def test_batch_writer_writes_a_failing_batch_item_by_item():
+    writer, written = batch_writer(lambda item: RuntimeError('bad item') if item == 2 else None,
+                                   retries=1)
+    for item in (1, 2, 3):
+        writer.add(item)
+    writer.flush()
+    assert writer.items == [1, 2, 3]
+
+    writer.flush()
+    assert (written, writer.items, list(writer.dead_letters)) == ([1, 3], [], [2])
+
+
+def test_batch_writer_does_not_retry_permanent_errors():
+    duplicate = IntegrityError('INSERT', {}, Exception('UNIQUE constraint failed'))
+    # Dead letters are bounded, the oldest ones are dropped.
+    writer, written = batch_writer(lambda item: duplicate if item == 2 else None,
+                                   dead_letters=1)
+    for item in (1, 2, 3, 2):
+        writer.add(item)
+    writer.flush()
+    assert (written, writer.items, list(writer.dead_letters)) == ([1, 3], [], [2])
+
+
+@pytest.mark.parametrize('query, found', [
+    ('', ['Alfred', 'alberto', 'carol', 'zed_ali']),
+    ('AL', ['Alfred', 'alberto']),
+    ('ali', ['zed_ali']),
+])
+def test_search_users_pages_by_username(session, query, found):
+    for username in ['zed_ali', 'carol', 'alberto', 'Alfred', 'alice']:
+        session.add(User(username=username, password='x'))
+    session.commit()
+    alice = User.query.filter_by(username='alice').one()
+
+    pages, after = [], None
+    while True:
+        users, after = search_users(query, alice, after=after, limit=1)
+        pages.append([user.username for user in users])
+        if after is None:
+            break
+    assert pages == [[username] for username in found]
+
+
+def test_seeded_usernames_are_free(engine):
+    with engine.connect() as connection:
+        assert username_prefix(connection, 3) == 'user'
+        engine.execute(User.__table__.insert(), {'id': 3, 'username': 'user4', 'password': 'x'})
+        assert username_prefix(connection, 4) == 'user4_1_'
+
+
+def test_avatar_url_follows_the_request():
+    image = f'{"0" * 32}.jpg'
+    with app.test_request_context('/', base_url='http://localhost/social/'):
+        assert avatar_url('alice', image, 'sm') == f'/social/avatars/{"0" * 32}-sm.jpg'
+    with app.test_request_context('/'):
+        assert avatar_url('alice', image, 'sm') == f'/avatars/{"0" * 32}-sm.jpg'
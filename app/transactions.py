@@ -0,0 +1,40 @@
+import logging
+from functools import wraps
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+def read_only(f):
+    ''' Run the view in a transaction that is rolled back, never committed. '''
+
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        session = current_app.extensions['sqlalchemy'].db.session
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if session.new or session.dirty or session.deleted:
+                logger.warning('Read-only view %s changed the session, rolling back.',
+                               f.__name__)
+            session.rollback()
+
+    return wrapped
+
+
+def transactional(f):
+    ''' Commit exactly once after the view returns, roll back if it raises. '''
+
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        session = current_app.extensions['sqlalchemy'].db.session
+        try:
+            rv = f(*args, **kwargs)
+        except BaseException:
+            session.rollback()
+            raise
+        session.commit()
+        return rv
+
+    return wrapped
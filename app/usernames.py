@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy import event, inspect, select
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    '''
+    Set membership in `capacity` * ~10 bits: no false negatives, about `error_rate`
+    false positives once `capacity` items were added.
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # Double hashing, two halves of one digest stand in for `hashes` hash functions.
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & 1 << (position & 7)
+                   for position in self.positions(item))
+
+
+class UsernameFilter:
+    '''
+    Usernames that may be taken. A name the filter doesn't contain is definitely free,
+    only the others need a query.
+
+    The filter is built from the users table in the background when the app starts,
+    every name counts as maybe taken until it is ready. It is rebuilt every `ttl` seconds,
+    to pick up users registered by other workers, while the old one is still used. Users
+    added through the session are added at once. A name registered elsewhere since the
+    last build can be reported free, the unique constraint on `users.username` still holds.
+    '''
+
+    def __init__(self, db, model, capacity=100000, error_rate=0.01, ttl=600):
+        self.db = db
+        self.model = model
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.bloom = None
+        self.built_at = 0
+        self.lock = threading.Lock()
+        self.building = False
+        # Names added while the filter is rebuilt, they may be missing from it.
+        self.pending = None
+
+        event.listen(db.session, 'after_flush', self.collect_usernames)
+
+    def start(self):
+        ''' Build the filter in a background thread, unless it is already being built. '''
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    def rebuild(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception('Could not build the username filter.')
+        finally:
+            with self.lock:
+                self.building = False
+
+    def build(self):
+        with self.lock:
+            self.pending = []
+
+        session = self.db.create_session({})()
+        try:
+            usernames = [row[0] for row in session.execute(select([self.model.username]))]
+        finally:
+            session.close()
+        bloom = BloomFilter(max(self.capacity, 2 * len(usernames)), self.error_rate)
+        for username in usernames:
+            bloom.add(username)
+
+        with self.lock:
+            for username in self.pending:
+                bloom.add(username)
+            self.bloom, self.pending = bloom, None
+            self.built_at = time.monotonic()
+
+    def current(self):
+        ''' The filter, None until it is first built. '''
+        if self.bloom is None or time.monotonic() - self.built_at > self.ttl:
+            self.start()
+        return self.bloom
+
+    def add(self, username):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(username)
+            if self.bloom is not None:
+                self.bloom.add(username)
+
+    def may_exist(self, username):
+        bloom = self.current()
+        return bloom is None or username in bloom
+
+    def taken(self, usernames):
+        ''' The subset of `usernames` that belong to users, in one query at most. '''
+        bloom = self.current()
+        candidates = {username for username in usernames if bloom is None or username in bloom}
+        if not candidates:
+            return set()
+
+        column = self.model.username
+        query = select([column]).where(column.in_(candidates))
+        return {row[0] for row in self.db.session.execute(query)}
+
+    def collect_usernames(self, session, flush_context):
+        for instance in session.new | session.dirty:
+            if isinstance(instance, self.model):
+                for username in inspect(instance).attrs.username.history.added:
+                    self.add(username)
+
+    @property
+    def stats(self):
+        bloom = self.bloom
+        return {'usernames': bloom.count, 'bits': bloom.size} if bloom else {}
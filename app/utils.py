@@ -1,6 +1,6 @@
 from functools import wraps
 
-from flask import redirect
+from flask import redirect, request
 from flask_login import current_user
 from flask_socketio import disconnect
 
@@ -26,3 +26,14 @@ def authenticated_only(f):
             return f(*args, **kwargs)
 
     return wrapped
+
+
+def user_room(user_id):
+    ''' Socket.IO room joined by every socket of the user. '''
+    return f'user:{user_id}'
+
+
+def wants_json():
+    ''' The client prefers a JSON answer, like the friend buttons patching the page. '''
+    best = request.accept_mimetypes.best_match(['text/html', 'application/json'])
+    return best == 'application/json'
@@ -1,15 +1,23 @@
-import os
+from datetime import datetime
 
-from flask import (abort, flash, jsonify, redirect, render_template, request,
-                   send_from_directory, url_for)
+from flask import (Markup, abort, flash, jsonify, redirect, render_template, request,
+                   url_for)
 from flask_login import current_user, login_required, login_user, logout_user
-from flask_socketio import emit
-from werkzeug.utils import secure_filename
-
-from . import app, db, socketio
+from flask_socketio import join_room, leave_room
+from sqlalchemy.exc import IntegrityError
+
+from . import (app, chat_sender, db, fragments, instrumentation, message_archive, message_ids,
+               message_writer, notifier, presence, read_receipts, socketio, user_cache, usernames,
+               workers)
+from .avatars import (AVATAR_FILENAME, InvalidAvatar, is_avatar_key, process_avatar,
+                      send_avatar_file, send_legacy_avatar_file)
 from .forms import ChangeAvatarForm, LoginForm, MessageCreateForm, RegisterForm
-from .models import Friendship, FriendshipRequest, Message, User
-from .utils import anonymous_required, authenticated_only
+from .models import Conversation, Friendship, FriendshipRequest, Message, User
+from .protocol import COMPACT_PROTOCOL, messages_room
+from .search import search_messages, search_users
+from .serializers import serialize_message, serialize_user, serialize_users
+from .transactions import read_only, transactional
+from .utils import anonymous_required, authenticated_only, user_room, wants_json
 
 
 @app.errorhandler(404)
@@ -22,6 +30,63 @@ def internal_server_error(error):
     return render_template('500.html'), 500
 
 
+def get_user_or_404(username):
+    user = user_cache.get_by_username(username)
+    if user is None:
+        abort(404)
+    return user
+
+
+def graph_changed(*user_ids):
+    ''' Friends or friendship requests of the users changed, re-render their fragments. '''
+    User.bump_graph_versions(user_ids)
+    user_cache.invalidate(*user_ids)
+
+
+# The status of the current user towards a user, seen from the other side.
+OTHER_SIDE_STATUS = {'friend': 'friend', 'requested': 'received', 'received': 'requested'}
+
+
+def friendship_changed(user, status):
+    '''
+    The current user's friendship status towards `user` is `status` now, None when they
+    are strangers. Both of them are told once it is committed, and the payload of that
+    event is returned for the JSON variants of the friend routes.
+    '''
+    graph_changed(current_user.id, user.id)
+
+    notifier.push(user.id, 'friendship', {
+        'user': serialize_user(current_user),
+        'status': OTHER_SIDE_STATUS.get(status),
+    })
+    data = {'user': serialize_user(user), 'status': status}
+    notifier.push(current_user.id, 'friendship', data)
+    return data
+
+
+def presence_changed(user, online):
+    ''' Tell the friends of the user that are online that it came online or went offline. '''
+    notifier.send(presence.online(user.friend_ids()), 'presence', {
+        'user': user.username,
+        'online': online,
+    })
+
+
+def presence_expired(user_ids):
+    ''' Users whose last session expired without a disconnect went offline too. '''
+    with app.app_context():
+        for user_id in user_ids:
+            user = user_cache.get(user_id)
+            if user is not None:
+                presence_changed(user, False)
+
+
+@app.before_first_request
+def start_presence():
+    presence.start(presence_expired)
+    chat_sender.start()
+
+
 @app.route('/')
 @anonymous_required
 def home():
@@ -30,6 +95,7 @@ def home():
 
 @app.route('/login', methods=['GET', 'POST'])
 @anonymous_required
+@transactional
 def login():
     form = LoginForm()
 
@@ -40,6 +106,10 @@ def login():
             flash('Invalid username or/and password.', 'danger')
             return render_template('login.html', form=form)
 
+        # Upgrade the hash while the password is at hand.
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+
         login_user(user)
         return redirect(user.get_profile_url())
 
@@ -47,24 +117,27 @@ def login():
 
 
 @app.route('/check-unique')
+@read_only
 def check_unique():
-    username = request.args.get('username')
+    candidates = request.args.getlist('username')
+    if not candidates or len(candidates) > app.config['USERNAME_CHECK_LIMIT']:
+        abort(400)
 
-    if username is not None:
-        if User.query.filter_by(username=username).first() is None:
-            return jsonify({'username': True})
+    taken = usernames.taken(candidates)
+    if len(candidates) == 1:
+        return jsonify({'username': candidates[0] not in taken})
 
-        return jsonify({'username': False})
+    return jsonify({'usernames': {name: name not in taken for name in candidates}})
 
 
 @app.route('/update-about', methods=['POST'])
+@transactional
 def update_about():
     about = request.get_json().get('about')
 
     if about is not None:
         current_user.about = about
         db.session.add(current_user)
-        db.session.commit()
         return jsonify({'about': about})
 
     return jsonify({'about': None})
@@ -72,6 +145,7 @@ def update_about():
 
 @app.route('/register', methods=['GET', 'POST'])
 @anonymous_required
+@transactional
 def register():
     form = RegisterForm()
 
@@ -79,7 +153,14 @@ def register():
         user = User(username=form.username.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+
+        # Taken since the form was validated.
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            form.username.errors.append('User with this username already exists.')
+            return render_template('register.html', form=form)
 
         flash(f'Account for {user.username} has been created.', 'success')
         return redirect(url_for('login'))
@@ -97,191 +178,434 @@ def logout():
 
 @app.route('/users/<username>')
 @login_required
+@read_only
 def profile(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    return render_template('profile.html', user=user)
+    user = get_user_or_404(username)
+    page = request.args.get('page', 1, type=int)
+
+    owner = user == current_user
+    status = None if owner else current_user.friendship_statuses([user]).get(user.id)
+
+    # The friend list and the requests are rendered once per version of the user's graph.
+    friends = requests = None
+    graph_version = user.current_graph_version() if owner or status == 'friend' else None
+    if owner or status == 'friend':
+        friends = fragments.get_or_set(
+            ('profile-friends', user.id, graph_version, page, owner),
+            lambda: render_template(
+                'profile-friends.html', user=user, owner=owner,
+                friends=user.friends_query().order_by(User.username).paginate(
+                    page, per_page=20, error_out=False)))
+    if owner:
+        requests = fragments.get_or_set(
+            ('profile-requests', user.id, graph_version),
+            lambda: render_template(
+                'profile-requests.html',
+                aspiring_friends=user.aspiring_friends_query().order_by(User.username).all(),
+                desired_friends=user.desired_friends_query().order_by(User.username).all()))
+
+    return render_template('profile.html', user=user, status=status,
+                           friends=friends and Markup(friends),
+                           requests=requests and Markup(requests))
 
 
 @app.route('/change-avatar', methods=['GET', 'POST'])
 @login_required
+@transactional
 def change_avatar():
     form = ChangeAvatarForm()
 
     if form.validate_on_submit():
-        # save file on disk.
-        image = form.image.data
-        image_name = secure_filename(image.filename)
-        image.save(os.path.join(app.config['UPLOAD_FOLDER'], image_name))
+        # resize and store the variants in a worker, named after their content.
+        try:
+            key = workers.run(process_avatar, form.image.data.read(),
+                              app.config['UPLOAD_FOLDER'], app.config['AVATAR_SIZES'])
+        except InvalidAvatar as e:
+            form.image.errors.append(str(e))
+        else:
+            current_user.image = key
+            db.session.add(current_user)
+            # Lists of friends and requests show the avatar.
+            graph_changed(*current_user.graph_neighbour_ids())
+            return redirect(current_user.get_profile_url())
 
-        # save path to file to db.
-        current_user.image = image_name
-        db.session.add(current_user)
-        db.session.commit()
+    return render_template('change-avatar.html', form=form)
 
-        return redirect(current_user.get_profile_url())
 
-    return render_template('change-avatar.html', form=form)
+@app.route('/avatars/<filename>')
+def avatar(filename):
+    # No login and no query, the URL names the file. Its hash is only known from pages
+    # showing the avatar.
+    match = AVATAR_FILENAME.match(filename)
+    if match is None or match['size'] not in app.config['AVATAR_SIZES']:
+        abort(404)
+    return send_avatar_file(app.config['UPLOAD_FOLDER'], filename,
+                            max_age=app.config['AVATAR_MAX_AGE'])
 
 
 @app.route('/send-avatar/<username>')
 @login_required
+@read_only
 def send_avatar(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    return send_from_directory(app.config['UPLOAD_FOLDER'], user.image)
+    user = get_user_or_404(username)
+    if user.image is None:
+        abort(404)
+
+    if is_avatar_key(user.image):
+        return redirect(user.get_image_url(request.args.get('size', 'md')))
+    return send_legacy_avatar_file(app.config['UPLOAD_FOLDER'], user.image)
 
 
 @app.route('/request-friend/<username>', methods=['POST'])
 @login_required
+@transactional
 def request_friend(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = get_user_or_404(username)
 
-    if user in current_user.friends:
+    if Friendship.are_friends(current_user, user):
         abort(400)
 
     friend_request = FriendshipRequest(receiving_user_id=user.id)
     current_user.requested_friendships.append(friend_request)
 
     db.session.add(current_user)
-    db.session.commit()
+    data = friendship_changed(user, 'requested')
 
+    if wants_json():
+        return jsonify(data)
     return redirect(user.get_profile_url())
 
 
 @app.route('/accept-friend/<username>', methods=['POST'])
 @login_required
+@transactional
 def accept_friend(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = get_user_or_404(username)
 
-    if user in current_user.friends:
+    if Friendship.are_friends(current_user, user):
         abort(400)
 
     current_user.received_friendships.filter_by(requesting_user=user).delete()
-    friendship = Friendship(user1=current_user, user2=user)
+    friendship = Friendship(current_user, user)
 
     db.session.add(friendship)
-    db.session.commit()
+    data = friendship_changed(user, 'friend')
 
+    if wants_json():
+        return jsonify(data)
     return redirect(current_user.get_profile_url())
 
 
 @app.route('/refuse-friend/<username>', methods=['POST'])
 @login_required
+@transactional
 def refuse_friend(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = get_user_or_404(username)
 
-    if user in current_user.friends:
+    if Friendship.are_friends(current_user, user):
         abort(400)
 
     current_user.received_friendships.filter_by(requesting_user=user).delete()
+    data = friendship_changed(user, None)
 
+    if wants_json():
+        return jsonify(data)
     return redirect(current_user.get_profile_url())
 
 
 @app.route('/delete-friend/<username>', methods=['POST'])
 @login_required
+@transactional
 def delete_friend(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = get_user_or_404(username)
 
-    current_user.friendships1.filter_by(user2=user).delete()
-    current_user.friendships2.filter_by(user1=user).delete()
+    Friendship.between(current_user.id, user.id).delete()
+    data = friendship_changed(user, None)
 
+    if wants_json():
+        return jsonify(data)
     flash(f'{username} has been deleted from your friends!', 'info')
     return redirect(current_user.get_profile_url())
 
 
 @app.route('/users')
 @login_required
+@read_only
 def users():
-    username = request.args.get('username',)
-    page = request.args.get('page', 1, type=int)
-
-    qs = User.query.filter(User.username != current_user.username)
-    if username is not None:
-        qs = qs.filter(User.username.contains(username))
-
-    pagination = qs.paginate(page, per_page=10, error_out=False)
-    return render_template('users.html', pagination=pagination)
+    username = request.args.get('username', '')
+    users, after = search_users(username, current_user, after=request.args.get('after'))
+    statuses = current_user.friendship_statuses(users)
+    return render_template('users.html', users=users, after=after, statuses=statuses)
 
 
 @app.route('/chats')
 @login_required
+@read_only
 def chats():
-    return render_template('chats.html')
+    try:
+        conversations, before = Conversation.inbox(current_user,
+                                                   before=request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    friends = None
+    if not conversations:
+        friends = current_user.friends
+
+    return render_template('chats.html',
+                           conversations=conversations,
+                           before=before,
+                           friends=friends)
 
 
 @app.route('/chats/<username>', methods=['GET'])
 @login_required
+@read_only
 def chat(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = get_user_or_404(username)
 
-    if user not in current_user.friends:
+    if not Friendship.are_friends(current_user, user):
         abort(404)
 
+    # In batched mode, show messages that are still waiting to be written.
+    message_writer.flush()
+
+    # The page marks what it shows as read over the socket, see `on_read`.
+    conversation = Conversation.get(current_user.id, user.id)
+    read_id = conversation.last_read_id(user) if conversation is not None else None
+
     form = MessageCreateForm()
-    messages = Message.query.filter((Message.sender_id == current_user.id) &
-                                    (Message.recipient_id == user.id) |
-                                    (Message.recipient_id == current_user.id) &
-                                    (Message.sender_id == user.id)).order_by(
-                                        Message.created_at).all()
+    messages, before = Message.history(current_user.id, user.id,
+                                       limit=app.config['MESSAGES_PER_PAGE'])
+    users = serialize_users(current_user, user)
+
+    return render_template('chat.html',
+                           user=user,
+                           messages=[serialize_message(message, users) for message in messages],
+                           before=before,
+                           read_id=read_id,
+                           form=form)
+
+
+@app.route('/chats/<username>/messages', methods=['GET'])
+@login_required
+@read_only
+def chat_history(username):
+    user = get_user_or_404(username)
+
+    if not Friendship.are_friends(current_user, user):
+        abort(404)
+
+    message_writer.flush()
+    users = serialize_users(current_user, user)
 
-    return render_template('chat.html', user=user, messages=messages, form=form)
+    try:
+        messages, before = Message.history(current_user.id,
+                                           user.id,
+                                           before=request.args.get('before'),
+                                           limit=app.config['MESSAGES_PER_PAGE'])
+    except ValueError:
+        abort(400)
+
+    return jsonify({
+        'messages': [serialize_message(message, users) for message in messages],
+        'before': before,
+    })
+
+
+@app.route('/messages/search')
+@login_required
+@read_only
+def message_search():
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    username = request.args.get('username')
+    other = get_user_or_404(username) if username else None
+
+    message_writer.flush()
+    pagination = search_messages(query, current_user, other, page,
+                                 per_page=app.config['MESSAGES_PER_PAGE'])
+
+    other_ids = {user_id for message, _ in pagination.items
+                 for user_id in (message.sender_id, message.recipient_id)} - {current_user.id}
+    others = User.query.filter(User.id.in_(other_ids)).all() if other_ids else []
+    users = serialize_users(current_user, *others)
+    results = [{**serialize_message(message, users), 'snippet': snippet}
+               for message, snippet in pagination.items]
+
+    if wants_json():
+        return jsonify({
+            'messages': results,
+            'page': pagination.page,
+            'pages': pagination.pages,
+            'total': pagination.total,
+        })
+    return render_template('messages-search.html',
+                           pagination=pagination,
+                           results=results,
+                           query=query,
+                           other=other)
 
 
 @app.route('/messages/<int:message_id>', methods=['DELETE'])
 @login_required
+@transactional
 def delete_message(message_id):
-    Message.query.filter(Message.id == message_id).delete()
+    message_writer.flush()
+
+    message = Message.query.filter_by(id=message_id, sender_id=current_user.id).first()
+    archived = message is None
+    if archived:
+        row = message_archive.delete(message_id, sender_id=current_user.id)
+        if row is None:
+            abort(404)
+        message = Message.from_archive(row)
+
+    conversation = Conversation.get(message.sender_id, message.recipient_id)
+    if conversation is not None:
+        conversation.forget_message(message)
+
+    if not archived:
+        db.session.delete(message)
     return {}, 204
 
 
-session_ids = {}
+@app.route('/stats')
+def stats():
+    if not app.config['STATS_ENDPOINT']:
+        abort(404)
+    return jsonify({
+        'endpoints': instrumentation.snapshot(),
+        'user_cache': user_cache.stats,
+        'fragments': fragments.stats,
+        'usernames': usernames.stats,
+        'message_archive': message_archive.stats,
+    })
 
 
 @socketio.on('connect', namespace='/chat')
+@socketio.on('connect', namespace=notifier.namespace)
+@instrumentation.socket_handler
 @authenticated_only
 def on_connect():
-    session_ids[current_user.username] = request.sid
+    join_room(user_room(current_user.id))
+    if request.namespace == '/chat':
+        # Until the socket says hello, see `on_hello`.
+        join_room(messages_room(current_user.id))
+        chat_sender.subscribe(current_user.id, request.sid)
+    if presence.add(current_user.id, request.sid):
+        presence_changed(current_user, True)
 
 
 @socketio.on('disconnect', namespace='/chat')
+@socketio.on('disconnect', namespace=notifier.namespace)
+@instrumentation.socket_handler
 @authenticated_only
 def on_disconnect():
-    del session_ids[current_user.username]
+    if request.namespace == '/chat':
+        chat_sender.unsubscribe(current_user.id, request.sid)
+    if presence.remove(current_user.id, request.sid):
+        presence_changed(current_user, False)
+
+
+@socketio.on('heartbeat', namespace='/chat')
+@socketio.on('heartbeat', namespace=notifier.namespace)
+@instrumentation.socket_handler
+@authenticated_only
+def on_heartbeat():
+    if request.namespace == '/chat':
+        chat_sender.heartbeat(current_user.id, request.sid)
+    # A session that expired meanwhile comes back, see `presence_expired`.
+    if presence.heartbeat(current_user.id, request.sid):
+        presence_changed(current_user, True)
+
+
+@socketio.on('hello', namespace='/chat')
+@instrumentation.socket_handler
+@authenticated_only
+def on_hello(data):
+    '''
+    Switch the socket to the compact protocol, if the client can speak it, and answer with
+    the profiles of the current user and `users`, the frames refer to them by id.
+    '''
+    encoding = chat_sender.negotiate(data)
+    if encoding is None:
+        return {'protocol': 1}
+
+    for room in [None] + chat_sender.encodings:
+        leave_room(messages_room(current_user.id, room))
+    join_room(messages_room(current_user.id, encoding))
+    chat_sender.subscribe(current_user.id, request.sid, encoding)
+
+    usernames = data.get('users')
+    usernames = usernames[:10] if isinstance(usernames, list) else []
+    others = (user_cache.get_by_username(username)
+              for username in usernames if isinstance(username, str))
+    return {
+        'protocol': COMPACT_PROTOCOL,
+        'encoding': encoding,
+        'users': serialize_users(current_user, *filter(None, others)),
+    }
+
+
+@socketio.on('profiles', namespace='/chat')
+@instrumentation.socket_handler
+@authenticated_only
+def on_profiles(user_ids):
+    ''' Profiles of the users a compact frame refers to but `on_hello` didn't send. '''
+    if not isinstance(user_ids, list):
+        return {}
+    users = (user_cache.get(user_id) for user_id in user_ids[:50] if isinstance(user_id, int))
+    return serialize_users(*filter(None, users))
+
+
+@socketio.on('read', namespace='/chat')
+@instrumentation.socket_handler
+@authenticated_only
+def on_read(data):
+    ''' Advance the reader's mark in the conversation with `user` to `message`. '''
+    other = user_cache.get_by_username(data.get('user', ''))
+    message_id = data.get('message')
+
+    if other is not None and other.id != current_user.id and isinstance(message_id, int):
+        read_receipts.mark(current_user, other, message_id)
 
 
 @socketio.on('message', namespace='/chat')
+@instrumentation.socket_handler
 @authenticated_only
 def on_message(data):
     recipient_username = data.get('recipient', '')
     body = data.get('body', '')
 
     if recipient_username and body:
-        recipient = User.query.filter_by(username=recipient_username).first()
+        recipient = user_cache.get_by_username(recipient_username)
+        if recipient is None:
+            return
+
+        # Everything the response needs is read before the commit expires these objects.
+        sender_id, recipient_id = current_user.id, recipient.id
+        users = serialize_users(current_user, recipient)
 
         # Create a new message.
-        message = Message(sender_id=current_user.id, recipient_id=recipient.id, body=body)
-        db.session.add(message)
-        db.session.commit()
-
-        # Create a response.
-        response = {
-            'type': 'update',
-            'data': {
-                'sender': {
-                    'username': message.sender.username,
-                    'imageUrl': message.sender.image_url,
-                },
-                'recipient': {
-                    'username': message.recipient.username,
-                    'imageUrl': message.recipient.image_url
-                },
-                'body': message.body,
-                'createdAt': message.formatted_created_at,
-                'id': message.id,
-            }
-        }
+        if app.config['MESSAGE_DURABILITY'] == 'batched':
+            # Deliver right away, the message is written with the next batch.
+            message = Message(id=message_ids(),
+                              sender_id=sender_id,
+                              recipient_id=recipient_id,
+                              body=body,
+                              created_at=datetime.utcnow())
+            prepared = chat_sender.prepare(message, users)
+            message_writer.add(message)
+        else:
+            message = Message(sender_id=sender_id, recipient_id=recipient_id, body=body)
+            db.session.add(message)
+            db.session.flush()
+            prepared = chat_sender.prepare(message, users)
+
+            # Update the inbox summary in the same transaction.
+            Conversation.record_messages([message])
+            db.session.commit()
 
         # Emit events.
-        emit('message', response)
-        if (recipient_room := session_ids.get(recipient.username)) is not None:
-            emit('message', response, room=recipient_room)
+        chat_sender.send(prepared)
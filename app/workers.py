@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_green():
+    ''' Whether the process runs on monkey patched eventlet threads. '''
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('thread')
+
+
+class WorkerPool:
+    '''
+    OS threads for CPU heavy or blocking calls, like decoding images, so they don't
+    stall the request that makes them. Under eventlet they go through eventlet.tpool,
+    where waiting for the result only blocks the calling greenlet.
+    '''
+
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def run(self, function, *args, **kwargs):
+        ''' Call `function` in a worker and return its result or raise its exception. '''
+        if is_green():
+            from eventlet import tpool
+            return tpool.execute(function, *args, **kwargs)
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.size, thread_name_prefix='worker')
+        return self.executor.submit(function, *args, **kwargs).result()
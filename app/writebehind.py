@@ -0,0 +1,197 @@
+import collections
+import logging
+import threading
+import time
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# Errors that fail the same way however often a batch is tried again.
+PERMANENT_ERRORS = (DataError, IntegrityError)
+
+
+class BatchWriter:
+    '''
+    Write-behind buffer: items are accepted right away and handed to
+    `handler(session, items)` in batches of at most `size` items, at least every
+    `interval` seconds. Every batch is committed once, in a session of its own.
+
+    A batch that fails is tried again with the next flush, up to `retries` times, unless
+    the error is one that retrying can't fix, like a constraint violation. Then its items
+    are written one by one and those that still fail are logged and kept in
+    `dead_letters`, so one bad item never holds up the others.
+    '''
+
+    def __init__(self, db, handler, size=100, interval=0.05, retries=3, dead_letters=1000):
+        self.db = db
+        self.handler = handler
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+
+        self.items = []
+        self.failures = 0
+        self.dead_letters = collections.deque(maxlen=dead_letters)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+            full = len(self.items) >= self.size
+            if self.thread is None:
+                # A daemon thread (a green one under eventlet), so it never holds up exit.
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+        # Under a burst the sender pays for the batch, which keeps the buffer bounded.
+        if full:
+            self.flush()
+
+    def run(self):
+        while not self.closed:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        '''
+        Write everything added so far before returning, but what failed. Never raises,
+        requests call it before reading and must not fail with a background write.
+        '''
+        with self.flush_lock:
+            with self.lock:
+                items, self.items = self.items, []
+            if not items:
+                return
+
+            session = self.db.create_session({})()
+            written = 0
+            try:
+                while written < len(items):
+                    batch = items[written:written + self.size]
+                    try:
+                        self.handler(session, batch)
+                        session.commit()
+                    except Exception as error:
+                        session.rollback()
+                        self.failures += 1
+                        transient = not isinstance(error, PERMANENT_ERRORS)
+                        if transient and self.failures <= self.retries:
+                            logger.warning('Could not write a batch, it will be retried.',
+                                           exc_info=True)
+                            # Keep the order, the failed items go in front of the ones added since.
+                            with self.lock:
+                                self.items[:0] = items[written:]
+                            return
+                        self.write_each(session, batch)
+                    self.failures = 0
+                    written += len(batch)
+            finally:
+                session.close()
+
+    def write_each(self, session, items):
+        for item in items:
+            try:
+                self.handler(session, [item])
+                session.commit()
+            except Exception:
+                session.rollback()
+                logger.exception('Could not write %r, it is dropped.', item)
+                self.dead_letters.append(item)
+
+    def close(self):
+        ''' Stop the background task and drain the buffer, called on shutdown. '''
+        self.closed = True
+        self.flush()
+
+
+class CoalescingWriter:
+    '''
+    Write-behind buffer that keeps only the latest value per key: `add(key, value)`
+    replaces the pending value of `key`, and every `interval` seconds the pending
+    (key, value) pairs are handed to `handler(session, items)` and committed, so a key
+    is written at most once per interval. `after_commit(result)` then gets what the
+    handler returned.
+    '''
+
+    def __init__(self, db, handler, interval=1.0, after_commit=None):
+        self.db = db
+        self.handler = handler
+        self.interval = interval
+        self.after_commit = after_commit
+
+        self.items = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def add(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while not self.closed:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not write the pending values, they will be retried.')
+
+    def flush(self):
+        ''' Write everything added so far before returning. '''
+        with self.flush_lock:
+            with self.lock:
+                items, self.items = self.items, {}
+            if not items:
+                return
+
+            session = self.db.create_session({})()
+            try:
+                result = self.handler(session, list(items.items()))
+                session.commit()
+            except Exception:
+                session.rollback()
+                # Values added since replace the failed ones.
+                with self.lock:
+                    self.items = {**items, **self.items}
+                raise
+            finally:
+                session.close()
+
+        if self.after_commit is not None:
+            self.after_commit(result)
+
+    def close(self):
+        ''' Stop the background task and drain the buffer, called on shutdown. '''
+        self.closed = True
+        self.flush()
+
+
+class IdAllocator:
+    '''
+    Hand out ids from blocks of `size` consecutive values, so ids are known before
+    the rows are written. `reserve(count)` must atomically reserve a block shared
+    by all workers and return its first value.
+    '''
+
+    def __init__(self, reserve, size=1000):
+        self.reserve = reserve
+        self.size = size
+        self.lock = threading.Lock()
+        self.next = self.end = 0
+
+    def __call__(self):
+        with self.lock:
+            if self.next >= self.end:
+                self.next = self.reserve(self.size)
+                self.end = self.next + self.size
+            value = self.next
+            self.next += 1
+        return value
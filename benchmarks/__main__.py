@@ -0,0 +1,138 @@
+'''
+Latency and throughput of the HTTP routes and the chat socket at several dataset scales.
+
+    python -m benchmarks run [--scales 1000 10000] [--requests 200] [--output results.json]
+    python -m benchmarks compare baseline.json results.json [--threshold 0.1]
+
+`run` saves to instance/benchmark-results.json unless --output says otherwise.
+`compare` prints the change of every scenario and exits with 1 when any got slower than
+the threshold, so it can gate a change.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app's instance folder, kept out of git.
+OUTPUT = os.path.join(ROOT, 'instance', 'benchmark-results.json')
+
+# Compared between runs, lower is better. Only the median decides, tails are too noisy
+# at a few hundred requests.
+METRICS = ('p50 ms', 'p99 ms')
+GATE = 'p50 ms'
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = {}
+    for users in args.scales:
+        print(f'Benchmarking with {users} users...', file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            # A process per scale, the app binds to its database when it is imported.
+            subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--users', str(users),
+                            '--requests', str(args.requests), '--seed', str(args.seed),
+                            '--output', output.name], cwd=ROOT, check=True)
+            results[str(users)] = json.load(output)
+
+    report = {
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'requests': args.requests,
+        'seed': args.seed,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_table(results)
+    print(f'Saved to {args.output}', file=sys.stderr)
+
+
+def print_table(results):
+    for users, scenarios in results.items():
+        print(f'\n{users} users')
+        columns = list(next(iter(scenarios.values())))
+        print(f'{"scenario":<26}' + ''.join(f'{column:>10}' for column in columns))
+        for name, stats in scenarios.items():
+            print(f'{name:<26}' + ''.join(
+                f'{value:>10.2f}' if isinstance(value, float) else f'{value:>10}'
+                for value in stats.values()))
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    print(f'{baseline["revision"]} -> {current["revision"]}')
+    regressions = 0
+    for users, scenarios in current['results'].items():
+        before = baseline['results'].get(users, {})
+        print(f'\n{users} users')
+        for name, stats in scenarios.items():
+            if name not in before:
+                continue
+            changes = []
+            for metric in METRICS:
+                change = stats[metric] / before[name][metric] - 1 if before[name][metric] else 0
+                changes.append(f'{metric} {before[name][metric]:8.2f} -> {stats[metric]:8.2f} '
+                               f'({change:+6.1%})')
+                if metric == GATE:
+                    gate = change
+
+            verdict = ''
+            if gate > args.threshold:
+                verdict = 'REGRESSION'
+                regressions += 1
+            elif gate < -args.threshold:
+                verdict = 'faster'
+            print(f'{name:<26}' + '  '.join(changes) + f'  {verdict}')
+
+    if regressions:
+        print(f'\n{regressions} regressions over {args.threshold:.0%}')
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = commands.add_parser('run', help='Benchmark the working tree.')
+    parser_run.add_argument('--scales', type=int, nargs='+', default=[1000, 10000],
+                            help='Numbers of seeded users.')
+    parser_run.add_argument('--requests', type=int, default=200,
+                            help='Measured requests per scenario.')
+    parser_run.add_argument('--seed', type=int, default=0)
+    parser_run.add_argument('--output', default=OUTPUT)
+    parser_run.set_defaults(function=run)
+
+    parser_compare = commands.add_parser('compare', help='Compare two saved runs.')
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative slowdown reported as a regression.')
+    parser_compare.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
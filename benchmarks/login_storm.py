@@ -0,0 +1,88 @@
+'''
+Event loop latency under eventlet while many logins hash passwords at once, with
+the hashing done inline and in the worker pool.
+
+A ticker greenlet stands in for the chat sockets: it asks to wake up every few
+milliseconds and records how late it actually runs.
+
+    python benchmarks/login_storm.py [--logins 200] [--concurrency 50] [--tick 5]
+'''
+import eventlet
+
+eventlet.monkey_patch()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+from app.workers import WorkerPool  # noqa: E402
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def run(pooled, logins, concurrency, tick):
+    pool = WorkerPool(config.WORKER_THREADS)
+
+    def login(n):
+        if pooled:
+            pool.run(generate_password_hash, f'password{n}', method=config.PASSWORD_HASH_METHOD)
+        else:
+            generate_password_hash(f'password{n}', method=config.PASSWORD_HASH_METHOD)
+
+    delays = []
+    done = False
+
+    def ticker():
+        while not done:
+            start = time.perf_counter()
+            eventlet.sleep(tick)
+            delays.append(time.perf_counter() - start - tick)
+
+    ticking = eventlet.spawn(ticker)
+    eventlet.sleep(tick * 10)
+
+    start = time.perf_counter()
+    green_pool = eventlet.GreenPool(concurrency)
+    for _ in green_pool.imap(login, range(logins)):
+        pass
+    elapsed = time.perf_counter() - start
+
+    done = True
+    ticking.wait()
+
+    return {
+        'hashing': 'pool' if pooled else 'inline',
+        'logins/s': logins / elapsed,
+        'tick p50 ms': percentile(delays, 0.5) * 1000,
+        'tick p99 ms': percentile(delays, 0.99) * 1000,
+        'tick max ms': max(delays) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--tick', type=float, default=5, help='milliseconds')
+    args = parser.parse_args()
+
+    rows = [run(pooled, args.logins, args.concurrency, args.tick / 1000)
+            for pooled in (False, True)]
+    columns = list(rows[0])
+    print(' | '.join(f'{column:>12}' for column in columns))
+    for row in rows:
+        print(' | '.join(f'{value:>12.1f}' if isinstance(value, float) else f'{value:>12}'
+                         for value in row.values()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Concurrent page reads and message writes against SQLite, with the default journal
+and with SQLITE_PRAGMAS from config.py.
+
+    python benchmarks/sqlite_locking.py [--seconds 5] [--readers 8] [--writers 4]
+'''
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+from app.database import set_sqlite_pragmas  # noqa: E402
+
+SCHEMA = '''
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY,
+    sender_id INTEGER NOT NULL,
+    recipient_id INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    created_at DATETIME NOT NULL
+)
+'''
+INDEX = '''
+CREATE INDEX ix_messages_sender_id_recipient_id_created_at
+ON messages (sender_id, recipient_id, created_at)
+'''
+READ = '''
+SELECT * FROM messages WHERE sender_id = :sender AND recipient_id = :recipient
+ORDER BY created_at DESC, id DESC LIMIT 50
+'''
+WRITE = '''
+INSERT INTO messages (sender_id, recipient_id, body, created_at)
+VALUES (:sender, :recipient, :body, CURRENT_TIMESTAMP)
+'''
+
+
+def make_engine(path, tuned):
+    url = f'sqlite:///{path}'
+    if not tuned:
+        return create_engine(url, poolclass=NullPool)
+
+    engine = create_engine(url,
+                           poolclass=QueuePool,
+                           connect_args={'check_same_thread': False},
+                           **config.SQLALCHEMY_ENGINE_OPTIONS)
+    set_sqlite_pragmas(engine, config.SQLITE_PRAGMAS)
+    return engine
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def run(tuned, seconds, readers, writers):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    engine = make_engine(path, tuned)
+    with engine.begin() as connection:
+        connection.execute(text(SCHEMA))
+        connection.execute(text(INDEX))
+        for i in range(5000):
+            connection.execute(text(WRITE), sender=i % 10, recipient=(i + 1) % 10, body='x' * 80)
+
+    stop = time.monotonic() + seconds
+    results = {'read': [], 'write': [], 'locked': 0}
+    lock = threading.Lock()
+
+    def worker(kind, n):
+        latencies, locked = [], 0
+        while time.monotonic() < stop:
+            params = {'sender': n % 10, 'recipient': (n + 1) % 10, 'body': 'x' * 80}
+            start = time.perf_counter()
+            try:
+                with engine.begin() as connection:
+                    if kind == 'read':
+                        connection.execute(text(READ), **params).fetchall()
+                    else:
+                        connection.execute(text(WRITE), **params)
+            except OperationalError:
+                locked += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        with lock:
+            results[kind].extend(latencies)
+            results['locked'] += locked
+
+    threads = [threading.Thread(target=worker, args=('read', n)) for n in range(readers)]
+    threads += [threading.Thread(target=worker, args=('write', n)) for n in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    return {
+        'profile': 'tuned' if tuned else 'default',
+        'reads/s': len(results['read']) / seconds,
+        'writes/s': len(results['write']) / seconds,
+        'read p99 ms': percentile(results['read'], 0.99) * 1000,
+        'write p99 ms': percentile(results['write'], 0.99) * 1000,
+        'locked': results['locked'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    args = parser.parse_args()
+
+    rows = [run(tuned, args.seconds, args.readers, args.writers) for tuned in (False, True)]
+    columns = list(rows[0])
+    print(' | '.join(f'{column:>12}' for column in columns))
+    for row in rows:
+        print(' | '.join(f'{value:>12.1f}' if isinstance(value, float) else f'{value:>12}'
+                         for value in row.values()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+'''
+One benchmark run against a fresh database seeded with `--users` users, saved as JSON.
+Run through `python -m benchmarks run`, which starts one process per scale: the app
+reads its database URL when it is imported.
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'benchmark'
+WARMUP = 10
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def summarize(latencies, elapsed):
+    return {
+        'count': len(latencies),
+        'ops/s': len(latencies) / elapsed if elapsed else 0,
+        'mean ms': sum(latencies) / len(latencies) * 1000,
+        'p50 ms': percentile(latencies, 0.5) * 1000,
+        'p90 ms': percentile(latencies, 0.9) * 1000,
+        'p99 ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def measure(operation, requests):
+    ''' Call `operation(i)` `requests` times after a warmup, return its latency summary. '''
+    for i in range(WARMUP):
+        operation(i)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(requests):
+        began = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - began)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def expect(response, *codes):
+    if response.status_code not in codes:
+        raise RuntimeError(f'{response.request.path} returned {response.status_code}')
+    return response
+
+
+def run(users, requests, seed):
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+    from sqlalchemy import text
+
+    from app import app, db, socketio
+    from app.seed import build
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['UPLOAD_FOLDER'] = directory
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    with app.app_context():
+        db.create_all()
+        build(db, users, seed=seed, password=PASSWORD, log=lambda *args: None)
+
+        # The busiest conversation, and the most popular user of the graph.
+        sender_id, recipient_id = db.session.execute(text('''
+            SELECT sender_id, recipient_id FROM messages
+            GROUP BY sender_id, recipient_id ORDER BY count(*) DESC LIMIT 1
+        ''')).first()
+        popular_id = db.session.execute(text('''
+            SELECT user_id FROM (
+                SELECT user1_id AS user_id FROM friendship
+                UNION ALL SELECT user2_id FROM friendship
+            ) GROUP BY user_id ORDER BY count(*) DESC LIMIT 1
+        ''')).scalar()
+        strangers = [row[0] for row in db.session.execute(text('''
+            SELECT username FROM users WHERE id NOT IN (
+                SELECT user2_id FROM friendship WHERE user1_id = :id
+                UNION SELECT user1_id FROM friendship WHERE user2_id = :id)
+            AND id != :id ORDER BY id DESC LIMIT :limit
+        '''), {'id': sender_id, 'limit': 3 * (requests + WARMUP)})]
+
+        # Requests for the sender to accept and refuse, from users it didn't ask itself.
+        db.session.execute(text('''
+            DELETE FROM friendship_requests
+            WHERE requesting_user_id = :id OR receiving_user_id = :id
+        '''), {'id': sender_id})
+        db.session.execute(text('''
+            INSERT INTO friendship_requests (requesting_user_id, receiving_user_id)
+            SELECT id, :id FROM users WHERE username = :username
+        '''), [{'id': sender_id, 'username': name} for name in strangers[requests + WARMUP:]])
+        db.session.commit()
+        db.session.remove()
+
+    def username(user_id):
+        return f'user{user_id}'
+
+    def client(user_id):
+        c = app.test_client()
+        expect(c.post('/login', data={'username': username(user_id), 'password': PASSWORD}), 302)
+        return c
+
+    sender, recipient = client(sender_id), client(recipient_id)
+    popular = client(popular_id)
+    friend = username(recipient_id)
+
+    history = expect(sender.get(f'/chats/{friend}/messages'), 200).get_json()['before']
+
+    scenarios = {
+        'profile (own)': lambda i: expect(popular.get(f'/users/{username(popular_id)}'), 200),
+        'profile (friend)': lambda i: expect(sender.get(f'/users/{friend}'), 200),
+        'profile (other)': lambda i: expect(
+            sender.get(f'/users/{username(popular_id + 1 + i % 50)}'), 200),
+        'users': lambda i: expect(sender.get(f'/users?page={1 + i % 20}'), 200),
+        'users search (prefix)': lambda i: expect(
+            sender.get(f'/users?username=u{i % 10}'), 200),
+        'users search (substring)': lambda i: expect(
+            sender.get(f'/users?username={100 + i % 900}'), 200),
+        'chats': lambda i: expect(sender.get('/chats'), 200),
+        'chat': lambda i: expect(sender.get(f'/chats/{friend}'), 200),
+        'chat history': lambda i: expect(
+            sender.get(f'/chats/{friend}/messages', query_string={'before': history}), 200),
+        'check-unique': lambda i: expect(
+            sender.get(f'/check-unique?username={username(i % users + 1)}'), 200),
+    }
+
+    sent, received = iter(strangers), iter(strangers[requests + WARMUP:])
+    scenarios.update({
+        'request-friend': lambda i: expect(sender.post(f'/request-friend/{next(sent)}'), 302),
+        'accept-friend': lambda i: expect(sender.post(f'/accept-friend/{next(received)}'), 302),
+        'refuse-friend': lambda i: expect(sender.post(f'/refuse-friend/{next(received)}'), 302),
+    })
+
+    results = {name: measure(operation, requests) for name, operation in scenarios.items()}
+
+    socket = socketio.test_client(app, namespace='/chat', flask_test_client=sender)
+    listener = socketio.test_client(app, namespace='/chat', flask_test_client=recipient)
+
+    def send_message(i):
+        socket.emit('message', {'recipient': friend, 'body': f'benchmark {i}'}, namespace='/chat')
+        if not listener.get_received('/chat'):
+            raise RuntimeError('The recipient got no message.')
+        socket.get_received('/chat')
+
+    results['socket message'] = measure(send_message, requests)
+    socket.disconnect(namespace='/chat')
+    listener.disconnect(namespace='/chat')
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True, help='JSON file to write.')
+    args = parser.parse_args()
+
+    results = run(args.users, args.requests, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,134 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'social.db')
+SQLALCHEMY_DATABASE_URI = (os.environ.get('DATABASE_URL') or
+                           'sqlite:///' + os.path.join(BASE_DIR, 'social.db'))
+
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+    'pool_timeout': 30,
+}
+
+# Run on every new SQLite connection. WAL lets page reads go on while a socket handler
+# writes, and busy_timeout makes writers wait for each other instead of failing with
+# 'database is locked'.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-SQLALCHEMY_COMMIT_ON_TEARDOWN = True
+# Aggregate statement counts, database time, slowest statements and wall time per endpoint
+# and socket event, served on /stats. Only a INSTRUMENTATION_SAMPLE_RATE share of the
+# requests is measured, lower it in production.
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION') == '1'
+INSTRUMENTATION_SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', 1))
+INSTRUMENTATION_SLOWEST = 5
+
+# Measure every request and report it in X-DB-Statements, X-DB-Commits, X-DB-Time and
+# X-Request-Time headers.
+DB_STATS_HEADERS = os.environ.get('DB_STATS_HEADERS') == '1'
 
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'media')
 
+# Square variants stored for every uploaded avatar, in pixels.
+AVATAR_SIZES = {'sm': 80, 'md': 160, 'lg': 640}
+
+# Seconds browsers may keep an avatar, its URL changes with the image.
+AVATAR_MAX_AGE = 365 * 24 * 60 * 60
+
+# Let the front-end server send avatar files. For nginx set AVATAR_ACCEL_REDIRECT to an
+# internal location aliased to UPLOAD_FOLDER, e.g. /protected-avatars/. For Apache or
+# lighttpd with mod_xsendfile set USE_X_SENDFILE=1.
+AVATAR_ACCEL_REDIRECT = os.environ.get('AVATAR_ACCEL_REDIRECT') or None
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Threads for CPU heavy work kept off the request, like image processing and password
+# hashing. Under eventlet the work goes to its own pool, sized by EVENTLET_THREADPOOL_SIZE.
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 4))
+
+# werkzeug method for new password hashes. Older hashes are replaced when their user logs in.
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:' + os.environ.get('PASSWORD_HASH_ITERATIONS', '150000')
+PASSWORD_SALT_LENGTH = 16
+
+MESSAGES_PER_PAGE = 50
+
+# 'sync' commits every chat message before it is delivered. 'batched' numbers messages from
+# reserved id blocks, delivers them right away and writes them every MESSAGE_BATCH_INTERVAL
+# seconds or MESSAGE_BATCH_SIZE messages, trading the last interval of messages on a crash
+# for throughput. All workers must use the same mode.
+MESSAGE_DURABILITY = os.environ.get('MESSAGE_DURABILITY', 'sync')
+MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE', 200))
+MESSAGE_BATCH_INTERVAL = float(os.environ.get('MESSAGE_BATCH_INTERVAL', 0.05))
+MESSAGE_ID_BLOCK_SIZE = 1000
+
+# Read marks sent by chat pages are written, and the receipts sent, every READ_MARK_INTERVAL
+# seconds, once per reader and conversation.
+READ_MARK_INTERVAL = float(os.environ.get('READ_MARK_INTERVAL', 1))
+
+# Cold messages move to one compressed SQLite file per month in MESSAGE_ARCHIVE_FOLDER and
+# stay readable in the chat history. Messages older than MESSAGE_ARCHIVE_AFTER_DAYS, and all
+# but the last MESSAGE_HOT_LIMIT messages of a conversation, are moved by
+# `flask compact-messages`, a few conversations at a time. Run it from cron, or once as
+# `flask compact-messages --watch` to compact every MESSAGE_COMPACTION_INTERVAL seconds,
+# never from several processes. Messages older than MESSAGE_RETENTION_DAYS are deleted.
+# Unset, every message stays in the messages table.
+MESSAGE_ARCHIVE_FOLDER = os.environ.get('MESSAGE_ARCHIVE_FOLDER',
+                                        os.path.join(BASE_DIR, 'archive'))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', 0)) or None
+MESSAGE_HOT_LIMIT = int(os.environ.get('MESSAGE_HOT_LIMIT', 0)) or None
+MESSAGE_RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS', 0)) or None
+MESSAGE_COMPACTION_INTERVAL = int(os.environ.get('MESSAGE_COMPACTION_INTERVAL', 300))
+MESSAGE_COMPACTION_BATCH = 100
+
+# Message queue that fans Socket.IO emits out to every worker, e.g. redis://localhost:6379/0,
+# or sqla+sqlite:////tmp/socketio.db (needs kombu) to try several workers locally.
+# Leave empty when running a single worker.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+
+# Encodings for chat pages that speak the compact socket protocol, the first one a page
+# supports is used: msgpack (needs pip install msgpack), deflate (zlib compressed JSON) or
+# json, e.g. CHAT_ENCODINGS=msgpack,deflate,json. Their messages are sent in frames every
+# CHAT_FRAME_INTERVAL seconds, or one by one when 0. Empty, every page gets a 'message'
+# event per message. Which sockets speak what is kept in PRESENCE_URL.
+CHAT_ENCODINGS = [encoding for encoding in os.environ.get('CHAT_ENCODINGS', '').split(',')
+                  if encoding]
+CHAT_FRAME_INTERVAL = float(os.environ.get('CHAT_FRAME_INTERVAL', 0))
+
+# Registry of open sockets per user: memory://, sqlite:////tmp/presence.db or redis://...
+PRESENCE_URL = os.environ.get('PRESENCE_URL', 'memory://')
+
+# Seconds a socket stays registered without a heartbeat.
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 60))
+
+# Users loaded for every request and socket event: memory:// keeps up to USER_CACHE_SIZE
+# of them per worker, redis://... shares them between workers. A change is only dropped
+# from the cache of the worker that made it, so with several workers (SOCKETIO_MESSAGE_QUEUE
+# set) it has to be redis://.
+USER_CACHE_URL = os.environ.get('USER_CACHE_URL', 'memory://')
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# Rendered parts of pages, like the friend list of a profile, same backends as above.
+FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL', 'memory://')
+FRAGMENT_CACHE_SIZE = 5000
+FRAGMENT_CACHE_TTL = 3600
+
+# Bloom filter of the taken usernames that answers /check-unique for free names without
+# a query, rebuilt every USERNAME_FILTER_TTL seconds to see users registered elsewhere.
+USERNAME_FILTER_CAPACITY = 100000
+USERNAME_FILTER_ERROR_RATE = 0.01
+USERNAME_FILTER_TTL = 600
+
+# Most usernames /check-unique answers for at once.
+USERNAME_CHECK_LIMIT = 50
+
+# Expose internal counters, like cache hits and misses and the instrumentation, as JSON
+# on /stats.
+STATS_ENDPOINT = os.environ.get('STATS_ENDPOINT') == '1'
+
 TEMPLATES_AUTO_RELOAD = True
@@ -0,0 +1,56 @@
+"""add messages search index
+
+Revision ID: 2e8b5f3c7a90
+Revises: 7c2f4a9d1e36
+Create Date: 2026-10-18 17:48:12.603517
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2e8b5f3c7a90'
+down_revision = '7c2f4a9d1e36'
+branch_labels = None
+depends_on = None
+
+
+def supports_message_search(connection):
+    # Other databases search with LIKE, see `app.search.search_messages`.
+    return connection.dialect.name == 'sqlite'
+
+
+def upgrade():
+    if not supports_message_search(op.get_bind()):
+        return
+    op.execute("""CREATE VIEW messages_search_content AS
+       SELECT id, body, 'u' || sender_id || ' u' || recipient_id AS participants
+       FROM messages""")
+    op.execute("""CREATE VIRTUAL TABLE messages_search
+       USING fts5(body, participants, content='messages_search_content', content_rowid='id')""")
+    op.execute("""CREATE TRIGGER messages_search_insert AFTER INSERT ON messages BEGIN
+         INSERT INTO messages_search(rowid, body, participants)
+         VALUES (new.id, new.body, 'u' || new.sender_id || ' u' || new.recipient_id);
+       END""")
+    op.execute("""CREATE TRIGGER messages_search_delete AFTER DELETE ON messages BEGIN
+         INSERT INTO messages_search(messages_search, rowid, body, participants)
+         VALUES ('delete', old.id, old.body, 'u' || old.sender_id || ' u' || old.recipient_id);
+       END""")
+    op.execute("""CREATE TRIGGER messages_search_update
+       AFTER UPDATE OF body, sender_id, recipient_id ON messages BEGIN
+         INSERT INTO messages_search(messages_search, rowid, body, participants)
+         VALUES ('delete', old.id, old.body, 'u' || old.sender_id || ' u' || old.recipient_id);
+         INSERT INTO messages_search(rowid, body, participants)
+         VALUES (new.id, new.body, 'u' || new.sender_id || ' u' || new.recipient_id);
+       END""")
+    op.execute("INSERT INTO messages_search(messages_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    if not supports_message_search(op.get_bind()):
+        return
+    op.execute('DROP TRIGGER IF EXISTS messages_search_update')
+    op.execute('DROP TRIGGER IF EXISTS messages_search_delete')
+    op.execute('DROP TRIGGER IF EXISTS messages_search_insert')
+    op.execute('DROP TABLE IF EXISTS messages_search')
+    op.execute('DROP VIEW IF EXISTS messages_search_content')
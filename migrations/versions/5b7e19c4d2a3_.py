@@ -0,0 +1,50 @@
+"""add users search index
+
+Revision ID: 5b7e19c4d2a3
+Revises: c41e8d2a6f70
+Create Date: 2026-10-18 13:02:41.527304
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e19c4d2a3'
+down_revision = 'c41e8d2a6f70'
+branch_labels = None
+depends_on = None
+
+
+def supports_trigram_index(connection):
+    # Other databases search with LIKE, see `app.search.search_users`.
+    dialect = connection.dialect
+    return dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 34)
+
+
+def upgrade():
+    if not supports_trigram_index(op.get_bind()):
+        return
+    op.execute("""CREATE VIRTUAL TABLE users_search
+       USING fts5(username, content='users', content_rowid='id', tokenize='trigram')""")
+    op.execute("""CREATE TRIGGER users_search_insert AFTER INSERT ON users BEGIN
+         INSERT INTO users_search(rowid, username) VALUES (new.id, new.username);
+       END""")
+    op.execute("""CREATE TRIGGER users_search_delete AFTER DELETE ON users BEGIN
+         INSERT INTO users_search(users_search, rowid, username)
+         VALUES ('delete', old.id, old.username);
+       END""")
+    op.execute("""CREATE TRIGGER users_search_update AFTER UPDATE OF username ON users BEGIN
+         INSERT INTO users_search(users_search, rowid, username)
+         VALUES ('delete', old.id, old.username);
+         INSERT INTO users_search(rowid, username) VALUES (new.id, new.username);
+       END""")
+    op.execute("INSERT INTO users_search(users_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    if not supports_trigram_index(op.get_bind()):
+        return
+    op.execute('DROP TRIGGER IF EXISTS users_search_update')
+    op.execute('DROP TRIGGER IF EXISTS users_search_delete')
+    op.execute('DROP TRIGGER IF EXISTS users_search_insert')
+    op.execute('DROP TABLE IF EXISTS users_search')